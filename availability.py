@@ -0,0 +1,131 @@
+import random
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+bulk_threshold = 16
+
+
+class Availability:
+
+    def __init__(self, num_pieces, bitfield):
+        self.num_pieces = num_pieces
+        self.bitfield = bitfield
+        self.counts = [0] * num_pieces
+        # each bucket is a shuffled list of the pieces we still need with
+        # that count, and positions maps a piece to its slot in the list
+        self.positions = [None] * num_pieces
+        missing = set(range(num_pieces)) - set(bitfield.set_bits())
+        self.buckets = [[]]
+        for index in missing:
+            self._insert(index, 0)
+        self.lock = threading.Lock()
+
+    def rarity(self, index):
+        return self.counts[index]
+
+    def add(self, index):
+        with self.lock:
+            self._move(index, 1)
+
+    def remove(self, index):
+        with self.lock:
+            self._move(index, -1)
+
+    def add_bitfield(self, bf):
+        with self.lock:
+            for i in bf.set_bits():
+                self._move(i, 1)
+
+    def remove_bitfield(self, bf):
+        with self.lock:
+            for i in bf.set_bits():
+                self._move(i, -1)
+
+    def add_bitfields(self, bitfields):
+        self._bulk(bitfields, 1)
+
+    def remove_bitfields(self, bitfields):
+        self._bulk(bitfields, -1)
+
+    def have(self, index):
+        with self.lock:
+            if self.positions[index] is not None:
+                self._discard(index, self.counts[index])
+
+    def rarest(self, bf=None, limit=None, exclude=()):
+        # the buckets are already in random order, so a tier is scanned
+        # from a random slot and only as far as it takes to find limit
+        # pieces
+        pieces = []
+        with self.lock:
+            for bucket in self.buckets[1:]:
+                size = len(bucket)
+                if not size:
+                    continue
+                start = random.randrange(size)
+                for slot in xrange(size):
+                    i = bucket[(start + slot) % size]
+                    if i in exclude or bf is not None and not bf[i]:
+                        continue
+                    pieces.append(i)
+                    if len(pieces) == limit:
+                        return pieces
+        return pieces
+
+    def _move(self, index, delta):
+        count = self.counts[index]
+        self.counts[index] = count + delta
+        # pieces we already have are not kept in any bucket
+        if self.positions[index] is not None:
+            self._discard(index, count)
+            self._insert(index, count + delta)
+
+    def _insert(self, index, count):
+        while count >= len(self.buckets):
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        # swap into a random slot to keep the bucket shuffled
+        slot = random.randint(0, len(bucket))
+        if slot == len(bucket):
+            bucket.append(index)
+        else:
+            other = bucket[slot]
+            bucket[slot] = index
+            bucket.append(other)
+            self.positions[other] = len(bucket) - 1
+        self.positions[index] = slot
+
+    def _discard(self, index, count):
+        bucket = self.buckets[count]
+        slot = self.positions[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[slot] = last
+            self.positions[last] = slot
+        self.positions[index] = None
+
+    def _bulk(self, bitfields, sign):
+        if numpy is None or len(bitfields) < bulk_threshold:
+            for bf in bitfields:
+                if sign > 0:
+                    self.add_bitfield(bf)
+                else:
+                    self.remove_bitfield(bf)
+            return
+        data = numpy.frombuffer(''.join(bf.pack() for bf in bitfields),
+            numpy.uint8).reshape(len(bitfields), -1)
+        bits = numpy.unpackbits(data, axis=1)[:, :self.num_pieces]
+        with self.lock:
+            # the sum has to be signed, uint8 bits would otherwise sum to
+            # uint64 and mix with the int64 counts into floats
+            counts = numpy.array(self.counts, numpy.int64) + \
+                sign * bits.sum(axis=0, dtype=numpy.int64)
+            self.counts = counts.astype(int).tolist()
+            missing = [i for bucket in self.buckets for i in bucket]
+            self.buckets = [[]]
+            for i in missing:
+                self._insert(i, self.counts[i])
@@ -0,0 +1,448 @@
+import hashlib
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import availability
+import bencode
+import bitfield
+import peers
+import picker
+import pieceio
+import reactor
+import wire
+
+
+def timeit(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, elapsed, size=None):
+    line = '%-30s %8.2f ms' % (name, elapsed * 1000)
+    if size:
+        line += ' %8.1f MB/s' % (size / elapsed / 2**20)
+    print line
+
+def synthetic_torrent(num_pieces=200000, num_files=200):
+    files = []
+    for i in range(num_files):
+        files.append({'length': 2**20, 'path': ['dir%d' % (i % 50),
+            'file%d.bin' % i]})
+    return bencode.bencode({
+        'announce': 'http://tracker.example.com:6969/announce',
+        'comment': 'synthetic benchmark torrent',
+        'info': {
+            'name': 'synthetic',
+            'piece length': 2**18,
+            'pieces': os.urandom(20 * num_pieces),
+            'files': files,
+        },
+    })
+
+def bench_bdecode(paths):
+    if paths:
+        torrents = [(path, open(path, 'rb').read()) for path in paths]
+    else:
+        torrents = [('synthetic', synthetic_torrent())]
+    for name, data in torrents:
+        print '%s (%d bytes)' % (name, len(data))
+        report('bdecode', timeit(lambda: bencode.bdecode(data)), len(data))
+        report('bdecode_buffer', timeit(lambda:
+            bencode.bdecode_buffer(data)), len(data))
+        report('bdecode_buffer lazy', timeit(lambda:
+            bencode.bdecode_buffer(data, True)), len(data))
+        report('bdecode_buffer lazy pieces', timeit(lambda:
+            bencode.bdecode_buffer(data, True)['info']['pieces']), len(data))
+
+class SyntheticInfo(dict):
+
+    def __init__(self, num_pieces, piece_size):
+        self.num_pieces = num_pieces
+        self.piece_size = piece_size
+
+def swarm(num_pieces, num_peers, seeds=0.1, have=0.3):
+    peers = []
+    for i in range(num_peers):
+        bf = bitfield.Bitfield(num_pieces)
+        for j in range(num_pieces):
+            if i < num_peers * seeds or random.random() < have:
+                bf[j] = 1
+        peers.append({'bitfield': bf, 'rate': random.randint(1, 8),
+            'queue': [], 'pieces': 0})
+    return peers
+
+def bench_picker(args):
+    num_pieces = int(args[0]) if args else 2000
+    num_peers = int(args[1]) if len(args) > 1 else 50
+    block_size = 2**14
+    info = SyntheticInfo(num_pieces, 4 * block_size)
+    total_size = num_pieces * info.piece_size - block_size / 2
+    ours = bitfield.Bitfield(num_pieces)
+    avail = availability.Availability(num_pieces, ours)
+    peers = swarm(num_pieces, num_peers)
+    for peer in peers:
+        avail.add_bitfield(peer['bitfield'])
+    pp = picker.PiecePicker(info, total_size, ours, avail, block_size)
+    blocks = [0] * num_pieces
+    rounds = 0
+    start = time.time()
+    while not ours.all():
+        rounds += 1
+        for peer in peers:
+            space = 2 * peer['rate'] - len(peer['queue'])
+            peer['queue'].extend(pp.pick(peer['bitfield'], space))
+            served = peer['queue'][:peer['rate']]
+            del peer['queue'][:peer['rate']]
+            for index, begin, length in served:
+                pp.received(index, begin)
+                blocks[index] += 1
+                if blocks[index] == pp.num_blocks(index):
+                    ours[index] = 1
+                    pp.completed(index)
+                    avail.have(index)
+                    peer['pieces'] += 1
+            if random.random() < 0.1:
+                i = random.randrange(num_pieces)
+                if not peer['bitfield'][i]:
+                    peer['bitfield'][i] = 1
+                    avail.add(i)
+    elapsed = time.time() - start
+    pieces = sorted(peer['pieces'] for peer in peers)
+    capacity = sum(peer['rate'] for peer in peers)
+    ideal = -(-num_pieces * pp.num_blocks(0) // capacity)
+    print '%d pieces from %d peers' % (num_pieces, num_peers)
+    print 'completed in %d rounds (%d with every peer saturated)' % \
+        (rounds, ideal)
+    print 'pieces per peer: min %d, median %d, max %d' % \
+        (pieces[0], pieces[len(pieces) / 2], pieces[-1])
+    report('picker', elapsed)
+
+def bench_storage(args):
+    size = int(args[0]) * 2**20 if args else 256 * 2**20
+    block_size = 2**14
+    info = SyntheticInfo(size / 2**18, 2**18)
+    info['name'] = 'payload'
+    info['length'] = size
+    data = os.urandom(block_size)
+    blocks = [(i, begin) for i in range(info.num_pieces)
+              for begin in range(0, info.piece_size, block_size)]
+    print '%d MB in %d blocks' % (size / 2**20, len(blocks))
+    for storage in sorted(pieceio.storages):
+        dl_dir = tempfile.mkdtemp()
+        try:
+            pio = pieceio.SingleFilePieceIO(info, [dl_dir], storage)
+            start = time.time()
+            for index, begin in blocks:
+                pio.write_piece(index, begin, data, True)
+            pio.close()
+            report('%s write' % storage, time.time() - start, size)
+            random.shuffle(blocks)
+            start = time.time()
+            for index, begin in blocks:
+                pio.read_piece(index, begin, block_size)
+            report('%s random read' % storage, time.time() - start, size)
+            pio.close()
+        finally:
+            shutil.rmtree(dl_dir)
+
+def bench_segments(args):
+    num_files = int(args[0]) if args else 50000
+    block_size = 2**14
+    info = SyntheticInfo(0, 2**18)
+    info['name'] = 'segments'
+    info['files'] = [{'length': random.randint(1, 2**16), 'path':
+        ['dir%d' % (i % 100), 'file%d' % i]} for i in range(num_files)]
+    pio = pieceio.MultiFilePieceIO(info, ['.'])
+    info.num_pieces = -(-pio.total_size // info.piece_size)
+    blocks = [(i, begin) for i in range(info.num_pieces)
+              for begin in range(0, info.piece_size, block_size)]
+    print '%d files, %d pieces' % (num_files, info.num_pieces)
+    report('position', timeit(lambda: [pio.position(index, begin)
+        for index, begin in blocks if index * info.piece_size + begin <
+        pio.total_size]))
+    report('segments', timeit(lambda: [pio.segments(index, begin,
+        block_size) for index, begin in blocks]))
+
+def bench_upload(args):
+    size = int(args[0]) * 2**20 if args else 256 * 2**20
+    num_peers = int(args[1]) if len(args) > 1 else 20
+    block_size = 2**14
+    info = SyntheticInfo(size / 2**18, 2**18)
+    info['name'] = 'payload'
+    info['length'] = size
+    dl_dir = tempfile.mkdtemp()
+    try:
+        pio = pieceio.SingleFilePieceIO(info, [dl_dir])
+        pio.bitfield = bitfield.Bitfield(info.num_pieces)
+        for i in range(info.num_pieces):
+            pio.write_piece(i, 0, os.urandom(info.piece_size), True)
+            pio.bitfield[i] = 1
+        # every peer fetches a few pieces block by block, popular pieces
+        # being requested by several peers at once
+        requests = []
+        for peer in range(num_peers):
+            for i in range(16):
+                index = min(int(random.expovariate(8.0 / info.num_pieces)),
+                            info.num_pieces - 1)
+                requests.extend((index, begin) for begin in
+                                range(0, info.piece_size, block_size))
+        random.shuffle(requests)
+        total = len(requests) * block_size
+        print '%d requests over %d pieces' % (len(requests), info.num_pieces)
+        report('read_piece', timeit(lambda: [pio.read_piece(index, begin,
+            block_size) for index, begin in requests], 3), total)
+        report('read_block', timeit(lambda: [pio.read_block(index, begin,
+            block_size) for index, begin in requests], 3), total)
+        print 'read cache hit rate %.2f' % \
+            pio.read_cache.stats()['hit rate']
+        pio.close()
+    finally:
+        shutil.rmtree(dl_dir)
+
+def usage():
+    if resource is None:
+        return 0, 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_maxrss, usage.ru_nvcsw + usage.ru_nivcsw
+
+def bench_peers(args):
+    num_conns = int(args[0]) if args else 1000
+    num_msgs = int(args[1]) if len(args) > 1 else 100
+    info_hash = os.urandom(20)
+    ours = bitfield.Bitfield(64)
+    loop = reactor.Reactor()
+    conns = []
+    connected = threading.Event()
+    received = threading.Event()
+    counts = {'connected': 0, 'received': 0}
+
+    def on_connect(conn):
+        counts['connected'] += 1
+        if counts['connected'] == 2 * num_conns:
+            connected.set()
+
+    def handle_msg(conn, msg_id, *args):
+        counts['received'] += 1
+        if counts['received'] == num_conns * num_msgs:
+            received.set()
+
+    def make(addr, sock=None):
+        conn = peers.PeerConn(peers.Peer(addr, None, len(ours)), sock,
+            info_hash, os.urandom(20), ours, lambda conn: None,
+            lambda up=0, down=0: None, lambda up=0, down=0, wasted=0: None,
+            handle_msg, loop, on_connect, lambda: False)
+        conn.connect()
+        return conn
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+    loop.register(reactor.Listener(server, lambda sock, addr:
+        make(addr, sock)), reactor.READ)
+    loop.start()
+    rss, switches = usage()
+    start = time.time()
+    for i in range(num_conns):
+        conns.append(make(server.getsockname()))
+    connected.wait()
+    report('%d handshakes' % num_conns, time.time() - start)
+    start = time.time()
+    for i in range(num_msgs):
+        for conn in conns:
+            conn.send_interested()
+    received.wait()
+    elapsed = time.time() - start
+    report('%d messages' % (num_conns * num_msgs), elapsed)
+    print '%d messages/s' % (num_conns * num_msgs / elapsed)
+    new_rss, new_switches = usage()
+    print '%d threads, %d KB max rss (+%d), %d context switches' % (
+        threading.active_count(), new_rss, new_rss - rss,
+        new_switches - switches)
+    for conn in conns:
+        conn.close()
+    loop.stop()
+    server.close()
+
+def loopback():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(server.getsockname())
+    conn, addr = server.accept()
+    server.close()
+    return client, conn
+
+def recv_exactly(sock, size):
+    data = sock.recv(size)
+    while len(data) != size:
+        data += sock.recv(size - len(data))
+    return data
+
+def bench_wire(args):
+    num_msgs = int(args[0]) if args else 200000
+    block = os.urandom(2**14)
+    msgs = []
+    for i in range(num_msgs):
+        if i % 10 == 0:
+            msgs.append(struct.pack('!IBII', 9 + len(block), 7, i, 0) +
+                        block)
+        elif i % 2:
+            msgs.append(struct.pack('!IBI', 5, 4, i))
+        else:
+            msgs.append(struct.pack('!IBIII', 13, 6, i, 0, 2**14))
+    stream = ''.join(msgs)
+
+    def run(parse):
+        sender, receiver = loopback()
+        thread = threading.Thread(target=sender.sendall, args=(stream,))
+        thread.start()
+        start = time.time()
+        parse(receiver)
+        elapsed = time.time() - start
+        thread.join()
+        sender.close()
+        receiver.close()
+        return elapsed
+
+    def naive(sock):
+        for i in range(num_msgs):
+            length, = struct.unpack('!I', recv_exactly(sock, 4))
+            msg_id = recv_exactly(sock, 1)
+            payload = recv_exactly(sock, length - 1)
+
+    def buffered(sock):
+        reader = wire.MessageReader(2**17)
+        count = 0
+        while count < num_msgs:
+            reader.recv_into(sock)
+            for msg in reader.messages():
+                count += 1
+
+    total = len(stream)
+    print '%d messages, %d bytes' % (num_msgs, total)
+    for name, parse in [('recv', naive), ('recv_into', buffered)]:
+        elapsed = run(parse)
+        report(name, elapsed, total)
+        print '%30s %8d messages/s' % ('', num_msgs / elapsed)
+
+def cpu_time():
+    if resource is None:
+        return time.clock()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def drain(sock):
+    while sock.recv(2**16):
+        pass
+
+def bench_serve(args):
+    size = int(args[0]) * 2**20 if args else 256 * 2**20
+    block_size = 2**14
+    info = SyntheticInfo(size / 2**18, 2**18)
+    info['name'] = 'payload'
+    info['length'] = size
+    dl_dir = tempfile.mkdtemp()
+    try:
+        pio = pieceio.SingleFilePieceIO(info, [dl_dir])
+        pio.bitfield = bitfield.Bitfield(info.num_pieces)
+        for i in range(info.num_pieces):
+            pio.write_piece(i, 0, os.urandom(info.piece_size), True)
+            pio.bitfield[i] = 1
+        blocks = [(i, begin) for i in range(info.num_pieces)
+                  for begin in range(0, info.piece_size, block_size)]
+        modes = ['buffered']
+        if wire.sendfile is not None:
+            modes.append('sendfile')
+        else:
+            print 'os.sendfile is not available, only buffered sends'
+        for mode in modes:
+            sender, receiver = loopback()
+            thread = threading.Thread(target=drain, args=(receiver,))
+            thread.start()
+            writer = wire.MessageWriter()
+            start, cpu = time.time(), cpu_time()
+            for index, begin in blocks:
+                header = wire.piece_header.pack(9 + block_size, 7, index,
+                                                begin)
+                if mode == 'sendfile':
+                    spans = [wire.FileSpan(f.fd, offset, length,
+                        lambda f=f: pio.files.release(f)) for f, offset,
+                        length in pio.open_segments(index, begin, block_size)]
+                    writer.write(header, *spans)
+                else:
+                    writer.write(header, pio.read_block(index, begin,
+                                                        block_size))
+                while not writer.flush(sender):
+                    pass
+            cpu = cpu_time() - cpu
+            report('%s send' % mode, time.time() - start, size)
+            print '%30s %8.2f s CPU per GB' % ('', cpu * 2**30 / size)
+            sender.close()
+            thread.join()
+            receiver.close()
+        pio.close()
+    finally:
+        shutil.rmtree(dl_dir)
+
+def bench_recheck(args):
+    size = int(args[0]) * 2**20 if args else 256 * 2**20
+    info = SyntheticInfo(size / 2**18, 2**18)
+    info['name'] = 'payload'
+    info['length'] = size
+    dl_dir = tempfile.mkdtemp()
+    try:
+        info.pieces = []
+        with open(os.path.join(dl_dir, 'payload'), 'wb') as f:
+            for i in range(info.num_pieces):
+                data = os.urandom(info.piece_size)
+                info.pieces.append(hashlib.sha1(data).digest())
+                f.write(data)
+        pio = pieceio.SingleFilePieceIO(info, [dl_dir])
+        print '%d MB in %d pieces' % (size / 2**20, info.num_pieces)
+        workers = 1
+        while workers <= multiprocessing.cpu_count():
+            report('recheck %d workers' % workers, timeit(lambda:
+                pio.create_bitfield(workers), 3), size)
+            workers *= 2
+        pio.close()
+    finally:
+        shutil.rmtree(dl_dir)
+
+
+benchmarks = {
+    'bdecode': bench_bdecode,
+    'peers': bench_peers,
+    'picker': bench_picker,
+    'recheck': bench_recheck,
+    'segments': bench_segments,
+    'serve': bench_serve,
+    'storage': bench_storage,
+    'wire': bench_wire,
+    'upload': bench_upload,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print 'usage: %s %s [args...]' % (sys.argv[0],
+            '|'.join(sorted(benchmarks)))
+        sys.exit(1)
+    benchmarks[sys.argv[1]](sys.argv[2:])
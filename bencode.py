@@ -1,23 +1,21 @@
+import cStringIO
+import io
+import mmap
+from UserDict import DictMixin
+
+# outputs that can write anything with the buffer interface, every other
+# file-like object is only ever given str
+buffer_outputs = (bytearray, file, io.BufferedIOBase, io.RawIOBase,
+                  type(cStringIO.StringIO()))
+
 
 def bencode(obj):
-    if isinstance(obj, str):
-        return ''.join([str(len(obj)), ':', obj])
-    elif isinstance(obj, unicode):
-        return bencode(obj.encode())
-    elif isinstance(obj, (int, long)):
-        return ''.join(['i', str(obj), 'e'])
-    elif isinstance(obj, list):
-        content = [bencode(i) for i in obj]
-        return ''.join(['l', ''.join(content), 'e'])
-    elif isinstance(obj, dict):
-        content = []
-        for i in sorted(obj.keys()):
-            content.append(bencode(i))
-            content.append(bencode(obj[i]))
-        return ''.join(['d', ''.join(content), 'e'])
-    else:
-        raise TypeError, 'unable to bencode %s' % type(obj)
-    
+    return str(bencode_into(obj, bytearray()))
+
+def bencode_into(obj, out):
+    Encoder(out).encode(obj)
+    return out
+
 def bdecode(s):
     try:
         ret, length = _bdecode(s, 0)
@@ -79,3 +77,319 @@ def _decode_dict(s, i):
         value, i = _bdecode(s, i)
         dct[key] = value
     return dct, i + 1
+
+
+TEXT_KEYS = frozenset(['announce', 'announce-list', 'comment', 'created by',
+    'encoding', 'failure reason', 'warning message', 'name', 'name.utf-8',
+    'path', 'path.utf-8', 'tracker id', 'url-list', 'ip'])
+
+def bdecode_buffer(s, lazy=False, spans=False, text_keys=TEXT_KEYS):
+    decoder = BufferDecoder(s, text_keys, lazy, spans)
+    try:
+        ret, length = decoder.decode(0)
+    except (IndexError, OverflowError, ValueError):
+        raise ValueError, 'bad bencoded data'
+    if length != len(s):
+        raise ValueError, 'bad bencoded data'
+    return ret
+
+def materialize(obj):
+    if isinstance(obj, (list, LazyList)):
+        return [materialize(item) for item in obj]
+    elif isinstance(obj, (dict, LazyDict)):
+        return dict((key, materialize(obj[key])) for key in obj.keys())
+    return obj
+
+def _view(s):
+    try:
+        return memoryview(s)
+    except TypeError:
+        # mmap objects only expose the old buffer interface
+        return memoryview(buffer(s))
+
+def _text(s):
+    try:
+        return unicode(s, 'utf-8')
+    except UnicodeError:
+        return s
+
+
+class BufferDecoder:
+
+    def __init__(self, data, text_keys=TEXT_KEYS, lazy=False, spans=False):
+        self.view = _view(data)
+        if isinstance(data, (str, mmap.mmap)):
+            self.data = data
+        else:
+            # memoryview, bytearray or buffer, scanned through the view
+            self.data = _Chars(self.view)
+        self.text_keys = text_keys
+        self.lazy = lazy
+        self.spans = spans
+        self.length = len(data)
+
+    def find(self, c, i):
+        end = self.data.find(c, i)
+        if end < 0:
+            raise ValueError
+        return end
+
+    def decode(self, i, text=False):
+        data = self.data
+        c = data[i]
+        if c == 'd':
+            if self.lazy:
+                spans, end = self._index_dict(i)
+                return LazyDict(self, spans), end
+            i += 1
+            if self.spans:
+                dct = SpanDict(self.view)
+            else:
+                dct = {}
+            text_keys = self.text_keys
+            while data[i] != 'e':
+                start, i = self._str_span(i)
+                key = data[start:i]
+                start = i
+                dct[key], i = self.decode(i, key in text_keys)
+                if self.spans:
+                    dct.spans[key] = start, i
+            return dct, i + 1
+        elif c == 'l':
+            if self.lazy:
+                spans, end = self._index_list(i)
+                return LazyList(self, spans, text), end
+            i += 1
+            lst = []
+            while data[i] != 'e':
+                item, i = self.decode(i, text)
+                lst.append(item)
+            return lst, i + 1
+        elif c == 'i':
+            return self._int(i)
+        start, end = self._str_span(i)
+        if text:
+            return _text(data[start:end]), end
+        return self.view[start:end], end
+
+    def skip(self, i):
+        data = self.data
+        c = data[i]
+        if c == 'd' or c == 'l':
+            i += 1
+            while data[i] != 'e':
+                i = self.skip(i)
+            return i + 1
+        elif c == 'i':
+            return self._int(i)[1]
+        return self._str_span(i)[1]
+
+    def _str_span(self, i):
+        data = self.data
+        if not data[i].isdigit():
+            raise ValueError
+        colon = self.find(':', i)
+        if data[i] == '0' and i + 1 != colon:
+            raise ValueError
+        length = int(data[i:colon])
+        colon += 1
+        end = colon + length
+        if length < 0 or end > self.length:
+            raise ValueError
+        return colon, end
+
+    def _int(self, i):
+        data = self.data
+        i += 1
+        end = self.find('e', i)
+        if data[i] == '0' and i + 1 != end:
+            raise ValueError
+        elif data[i:i+2] == '-0':
+            raise ValueError
+        return int(data[i:end]), end + 1
+
+    def _index_list(self, i):
+        i += 1
+        spans = []
+        while self.data[i] != 'e':
+            end = self.skip(i)
+            spans.append((i, end))
+            i = end
+        return spans, i + 1
+
+    def _index_dict(self, i):
+        i += 1
+        spans = {}
+        while self.data[i] != 'e':
+            start, i = self._str_span(i)
+            key = self.data[start:i]
+            end = self.skip(i)
+            spans[key] = i, end
+            i = end
+        return spans, i + 1
+
+
+class _Chars:
+
+    # str-like access to a memoryview: characters, small copied slices
+    # and find, which is only used for the short runs of digits
+
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.view[i].tobytes()
+        return self.view[i]
+
+    def find(self, c, i):
+        while i < len(self.view):
+            end = self.view[i:i + 32].tobytes().find(c)
+            if end >= 0:
+                return i + end
+            i += 32
+        return -1
+
+
+class LazyList(object):
+
+    def __init__(self, decoder, spans, text=False):
+        self._decoder = decoder
+        self._spans = spans
+        self._text = text
+        self._items = {}
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self._spans)
+        if index not in self._items:
+            start = self._spans[index][0]
+            self._items[index] = self._decoder.decode(start, self._text)[0]
+        return self._items[index]
+
+    def __iter__(self):
+        for i in range(len(self._spans)):
+            yield self[i]
+
+
+class LazyDict(DictMixin):
+
+    def __init__(self, decoder, spans):
+        self._decoder = decoder
+        self._spans = spans
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            start = self._spans[key][0]
+            text = key in self._decoder.text_keys
+            self._values[key] = self._decoder.decode(start, text)[0]
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._spans
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def keys(self):
+        return self._spans.keys()
+
+    def span(self, key):
+        return self._spans[key]
+
+    def raw(self, key):
+        start, end = self._spans[key]
+        return self._decoder.view[start:end]
+
+
+class SpanDict(dict):
+
+    def __init__(self, view):
+        dict.__init__(self)
+        self.view = view
+        self.spans = {}
+
+    def span(self, key):
+        return self.spans[key]
+
+    def raw(self, key):
+        start, end = self.spans[key]
+        return self.view[start:end]
+
+
+class Encoder:
+
+    def __init__(self, out):
+        if isinstance(out, bytearray):
+            self.write = out.extend
+        else:
+            self.write = out.write
+        self.buffers = isinstance(out, buffer_outputs)
+        self.stack = []
+
+    def encode(self, obj):
+        write = self.write
+        if isinstance(obj, (str, memoryview, buffer, bytearray)):
+            write('%d:' % len(obj))
+            if not self.buffers and not isinstance(obj, str):
+                obj = memoryview(obj).tobytes()
+            write(obj)
+        elif isinstance(obj, unicode):
+            self.encode(obj.encode('utf-8'))
+        elif isinstance(obj, (int, long)):
+            write('i%de' % obj)
+        elif isinstance(obj, (list, tuple, LazyList)):
+            write('l')
+            for item in obj:
+                self.encode(item)
+            write('e')
+        elif isinstance(obj, (dict, LazyDict)):
+            write('d')
+            for key in sorted(obj.keys()):
+                self.encode(key)
+                self.encode(obj[key])
+            write('e')
+        else:
+            raise TypeError, 'unable to bencode %s' % type(obj)
+
+    def encode_list(self, items):
+        self.start_list()
+        for item in items:
+            self.encode(item)
+        self.end()
+
+    def start_list(self):
+        self.write('l')
+        self.stack.append(None)
+
+    def start_dict(self):
+        self.write('d')
+        self.stack.append('')
+
+    def key(self, key):
+        if not self.stack or self.stack[-1] is None:
+            raise ValueError, 'not inside a dict'
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if self.stack[-1] and key <= self.stack[-1]:
+            raise ValueError, 'dict keys must be written in sorted order'
+        self.stack[-1] = key
+        self.encode(key)
+
+    def end(self):
+        if not self.stack:
+            raise ValueError, 'no open list or dict'
+        self.stack.pop()
+        self.write('e')
@@ -1,3 +1,8 @@
+import binascii
+
+_set_bits = [tuple(i for i in range(8) if byte >> (7 - i) & 1)
+             for byte in range(256)]
+
 
 class Bitfield:
 
@@ -7,51 +12,96 @@ class Bitfield:
         if self.size % 8:
             self.num_bytes += 1
         self.num_true = 0
-        self.bits = [0] * self.size
+        self.bytes = bytearray(self.num_bytes)
         if bitstring:
             self.unpack(bitstring)
 
     def pack(self):
-        bitstring = ''
-        for i in range(self.num_bytes):
-            bits = self.bits[i*8:i*8+8]
-            byte = 0
-            for i in range(len(bits)):
-                byte |= bits[i] << (7 - i)
-            bitstring += chr(byte)
-        return bitstring
+        return str(self.bytes)
 
     def unpack(self, bitstring):
         if len(bitstring) != self.num_bytes:
             raise ValueError, 'incorrect bitstring length'
-        empty_bits = len(bitstring) * 8 - self.size
-        for i in range(empty_bits):
-            if ord(bitstring[-1]) & (1 << i):
-                raise ValueError, 'unused bits are used'
-        self.num_true = 0
-        for i in range(self.size):
-            bit = ord(bitstring[i/8]) >> (7 - i % 8) & 1
-            if bit:
-                self.num_true += 1
-                self.bits[i] = bit
-                
+        bitstring = bytearray(bitstring)
+        empty_bits = self.num_bytes * 8 - self.size
+        if bitstring and bitstring[-1] & ((1 << empty_bits) - 1):
+            raise ValueError, 'unused bits are used'
+        self.bytes = bitstring
+        self.num_true = bin(self._int()).count('1')
+
     def __getitem__(self, index):
-        return self.bits[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError, 'bitfield index out of range'
+        return self.bytes[index >> 3] >> (7 - (index & 7)) & 1
 
     def __setitem__(self, index, flag=1):
         if flag != 0 and flag != 1:
             raise ValueError, 'flag must be 0 or 1'
-        self.bits[index] = flag
-        self.num_true += flag
+        old = self[index]
+        if index < 0:
+            index += self.size
+        mask = 1 << (7 - (index & 7))
+        if flag:
+            self.bytes[index >> 3] |= mask
+        else:
+            self.bytes[index >> 3] &= ~mask
+        self.num_true += flag - old
 
     def __len__(self):
         return self.size
 
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
     def __cmp__(self, other):
         return cmp(self.num_true, other.num_true)
 
+    def all(self):
+        return self.num_true == self.size
+
+    def any(self):
+        return self.num_true > 0
+
+    def set_bits(self):
+        for i, byte in enumerate(self.bytes):
+            if byte:
+                for bit in _set_bits[byte]:
+                    yield i * 8 + bit
+
+    def and_not(self, other):
+        bf = Bitfield(self.size)
+        value = self._and_not(other)
+        if value:
+            bf.bytes = bytearray(binascii.unhexlify('%0*x' %
+                (self.num_bytes * 2, value)))
+            bf.num_true = bin(value).count('1')
+        return bf
+
+    def any_and_not(self, other):
+        return self._and_not(other) != 0
+
+    def count_and_not(self, other):
+        return bin(self._and_not(other)).count('1')
+
+    def _and_not(self, other):
+        if self.size != other.size:
+            raise ValueError, 'bitfield sizes differ'
+        if not self.num_true:
+            return 0
+        return self._int() & ~other._int()
+
+    def _int(self):
+        if not self.bytes:
+            return 0
+        return int(binascii.hexlify(self.bytes), 16)
+
     def clone(self):
         bf = Bitfield(self.size)
-        for i in range(self.size):
-            bf.bits[i] = self.bits[i]
+        bf.bytes[:] = self.bytes
+        bf.num_true = self.num_true
         return bf
@@ -8,13 +8,17 @@ import metainfo
 import peers
 import pieceio
 import rates
+import reactor
+import resume
 
 bleh = False
 class BitTorrentClient:
 
     def __init__(self, metainfo_file, dl_dir=['downloads']):
         self.metainfo = metainfo.MetaInfo(metainfo_file)
-        self.pieceio = pieceio.PieceIO(self.metainfo.info, dl_dir)
+        self.resume_file = resume.resume_path(self.metainfo.info, dl_dir)
+        self.pieceio = pieceio.PieceIO(self.metainfo.info, dl_dir,
+            resume=resume.load(self.resume_file, self.metainfo.info_hash))
         self.peer_id = ''.join([chr(random.getrandbits(8)) for i in range(20)])
         self.udl = [0, 0, self.pieceio.data_left()]
         self.udl_lock = threading.Lock()
@@ -25,6 +29,7 @@ class BitTorrentClient:
             self.peer_id, self.pieceio.bitfield, self.pieceio,
             self.ud_rates.update, self.update_udl, self.piece_completed,
             self.reannounce)
+        self.listener = reactor.Listener(self.server, self.accept_peer)
         self.announcer = announce.Announcer(self.metainfo, self.peer_id,
             self.port, self.get_udl, self.tracker_callback)
         self.start()
@@ -34,7 +39,8 @@ class BitTorrentClient:
         self.announcer.start()
         self.running = True
         threading.Thread(target=self.rates_ticker).start()
-        threading.Thread(target=self.accept_peers).start()
+        self.peer_manager.reactor.call(self.peer_manager.reactor.register,
+            self.listener, reactor.READ)
 
     def pause(self):
         self.stop(True)
@@ -44,16 +50,24 @@ class BitTorrentClient:
             self.announcer.reannounce(2)
         else:
             self.announcer.stop()
+        self.peer_manager.reactor.call(self.peer_manager.reactor.unregister,
+            self.listener)
         self.peer_manager.stop()
+        self.pieceio.close()
+        self.save_resume()
         self.running = False
 
+    def save_resume(self):
+        resume.save(self.resume_file, self.metainfo.info_hash, self.pieceio,
+            self.peer_manager.pieces)
+
     def create_server(self):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.port = 6881
         while self.port < 6890:
             try:
                 self.server.bind(('localhost', self.port))
-                self.server.listen(1)
+                self.server.listen(5)
                 return
             except socket.error as err:
                 if err.errno in (10013, 10048) and self.port != 6889:
@@ -65,11 +79,9 @@ class BitTorrentClient:
         self.announcing = True
         self.announcer.reannounce(event)
 
-    def accept_peers(self):
-        while self.running:
-            conn, addr = self.server.accept()
-            print 'peer accepted', conn, addr
-            self.peer_manager.add_peer(addr, None, conn)
+    def accept_peer(self, conn, addr):
+        print 'peer accepted', conn, addr
+        self.peer_manager.add_peer(addr, None, conn)
 
     def update_tracker(self):
         self.announcer.reannounce()
@@ -96,16 +108,20 @@ class BitTorrentClient:
             return tuple(self.udl)
 
     def rates_ticker(self):
+        counter = 0
         while self.running:
             self.ud_rates.tick()
             self.peer_manager.tick_rates()
+            counter += 1
+            if counter % resume.save_interval == 0:
+                self.save_resume()
             time.sleep(1)
 
     def piece_completed(self, index):
         success = self.pieceio.verify_piece(index)
         with self.udl_lock:
-            self.udl[2] = self.piecio.data_left()
-        if all(self.pieceio.bitfield):
+            self.udl[2] = self.pieceio.data_left()
+        if self.pieceio.bitfield.all():
             self.reannounce(3)
         return success
         
@@ -0,0 +1,131 @@
+import collections
+import threading
+import time
+import traceback
+
+hash_priority = 0
+write_priority = 1
+upload_priority = 2
+num_workers = 4
+max_queued = 256
+
+
+class DiskIO:
+
+    def __init__(self, workers=num_workers, limit=max_queued, drained=None):
+        self.num_workers = workers
+        self.limit = limit
+        self.drained = drained
+        self.paused = False
+        self.queues = [collections.deque()
+                       for i in range(upload_priority + 1)]
+        self.keys = {}
+        self.queued = 0
+        self.running = False
+        self.busy = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.service_time = 0.0
+        self.max_wait = 0.0
+        self.workers = []
+        self.cond = threading.Condition()
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+            self.workers = [threading.Thread(target=self.work)
+                            for i in range(self.num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+    def submit(self, priority, key, func, args=(), block=True):
+        # jobs sharing a key run one at a time in submission order, and
+        # blocking callers wait while the queues are full, the reactor
+        # instead stops reading from peers until drained is called
+        job = (priority, key, func, args, time.time())
+        with self.cond:
+            while block and self.running and self.queued >= self.limit:
+                self.cond.wait()
+            self.queued += 1
+            if key is not None and key in self.keys:
+                self.keys[key].append(job)
+                return
+            elif key is not None:
+                self.keys[key] = collections.deque()
+            self.queues[priority].append(job)
+            self.cond.notify_all()
+
+    def full(self):
+        with self.cond:
+            # stays full until half the queue has drained, so reading
+            # is not switched back on and off for every job
+            if self.queued >= self.limit:
+                self.paused = True
+            return self.paused
+
+    def work(self):
+        while True:
+            with self.cond:
+                job = self._next()
+                while job is None and self.running:
+                    self.cond.wait()
+                    job = self._next()
+                if job is None:
+                    return
+                self.busy += 1
+            priority, key, func, args, submitted = job
+            started = time.time()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            finished = time.time()
+            with self.cond:
+                self.busy -= 1
+                self.queued -= 1
+                self.completed += 1
+                self.wait_time += started - submitted
+                self.service_time += finished - started
+                self.max_wait = max(self.max_wait, started - submitted)
+                drained = self.paused and self.queued <= self.limit // 2
+                if drained:
+                    self.paused = False
+                if key is not None:
+                    if self.keys[key]:
+                        job = self.keys[key].popleft()
+                        self.queues[job[0]].append(job)
+                    else:
+                        del self.keys[key]
+                self.cond.notify_all()
+            if drained and self.drained is not None:
+                self.drained()
+
+    def stats(self):
+        with self.cond:
+            completed = self.completed or 1
+            return {
+                'depth': [len(queue) for queue in self.queues],
+                'queued': self.queued,
+                'busy': self.busy,
+                'completed': self.completed,
+                'wait': self.wait_time / completed,
+                'service': self.service_time / completed,
+                'max wait': self.max_wait,
+            }
+
+    def _next(self):
+        for queue in self.queues:
+            if queue:
+                return queue.popleft()
+        return None
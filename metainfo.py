@@ -1,4 +1,5 @@
 import hashlib
+
 import bencode
 
 TEST_TORRENT = 'ubuntu-10.10-desktop-i386.iso.torrent'
@@ -7,30 +8,52 @@ TEST_TORRENT = 'ubuntu-10.10-desktop-i386.iso.torrent'
 class MetaInfo(dict):
 
     def __init__(self, metainfo_file):
+        # piece hashes stay views into this string, a mapping would keep
+        # a descriptor open for as long as the MetaInfo is alive
         with open(metainfo_file, 'rb') as f:
             data = f.read()
-        metainfo = bencode.bdecode(data)
+        metainfo = bencode.bdecode_buffer(data, lazy=True)
         self.info = Info(metainfo['info'])
         self['info'] = self.info
         for key, value in metainfo.items():
             if key != 'info':
-                self[key] = value
-        info_start = data.index('4:info') + 6
-        info_end = bencode._bdecode(data, info_start)[1]
-        sha1 = hashlib.sha1()
-        sha1.update(data[info_start:info_end])
+                self[key] = bencode.materialize(value)
+        self.info_raw = metainfo.raw('info')
+        sha1 = hashlib.sha1(self.info_raw)
         self.info_hash = sha1.digest()
         self.info_hash_hex = sha1.hexdigest()
 
 class Info(dict):
 
     def __init__(self, info):
-        self.pieces = []
-        for i in range(0, len(info['pieces']), 20):
-            self.pieces.append(info['pieces'][i:i+20])
+        self.pieces = PieceHashes(info['pieces'])
         self.num_pieces = len(self.pieces)
         self.piece_size = info['piece length']
         for key, value in info.items():
+            if key != 'files':
+                value = bencode.materialize(value)
             self[key] = value
 
+class PieceHashes:
+
+    def __init__(self, pieces):
+        if len(pieces) % 20:
+            raise ValueError, 'pieces length is not a multiple of 20'
+        self.view = pieces
+        self.size = len(pieces) / 20
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError, 'piece index out of range'
+        return self.view[index*20:index*20+20]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
 metainfo = MetaInfo(TEST_TORRENT)
@@ -1,13 +1,18 @@
+import collections
 import random
-import select
 import socket
 import struct
 import threading
 import time
 
+import availability
 import bencode
 import bitfield
+import diskio
+import picker
 import rates
+import reactor
+import wire
 
 names = ['choke','unchoke','interested','uninterested',
          'have','bitfield','request','piece','cancel']
@@ -40,6 +45,18 @@ ltep_handshake_id = 0x00
 
 block_size = 2**14
 
+min_queue_size = 2
+max_queue_size = 250
+request_timeout = 30
+
+max_message_size = 2**17
+max_request_size = 2**17
+max_send_buffer = 2**20
+
+upload_slots = 4
+choke_interval = 10
+optimistic_rounds = 3
+
 
 class PeerManager:
 
@@ -53,11 +70,23 @@ class PeerManager:
         self.update_udl = update_udl
         self.piece_completed = piece_completed
         self.reannounce = reannounce
-        self.num_blocks = self.metainfo.info.piece_size / block_size
+        self.availability = availability.Availability(
+            self.metainfo.info.num_pieces, self.bitfield)
+        self.picker = picker.PiecePicker(self.metainfo.info,
+            self.pieceio.total_size, self.bitfield, self.availability,
+            block_size)
         self.pieces = []
         for i in range(self.metainfo.info.num_pieces):
-            self.pieces.append([0]*self.num_blocks)
-        self._rarity = []
+            self.pieces.append([0]*self.picker.num_blocks(i))
+        for index, received in self.pieceio.resume_blocks.iteritems():
+            num_blocks = len(self.pieces[index])
+            if any(received[num_blocks:]):
+                continue
+            received = received[:num_blocks]
+            received += [0] * (num_blocks - len(received))
+            if not all(received):
+                self.pieces[index] = received
+                self.picker.restore(index, received)
         self.unchoked = []
         self.peers_unchoked = []
         self.interested = []
@@ -68,16 +97,25 @@ class PeerManager:
         self.connections = []
         self.conns_lock = threading.Lock()
         self.reannounced = False
+        self.endgame = False
+        self.upload_slots = upload_slots
+        self.optimistic = None
+        self.diskio = diskio.DiskIO(drained=self.resume_reading)
+        self.reactor = reactor.Reactor()
         self.start()
 
     def start(self):
         self.running = True
+        self.diskio.start()
+        self.reactor.start()
         threading.Thread(target=self.unchoker).start()
         threading.Thread(target=self.requester).start()
 
     def stop(self):
         self.running = False
         self.drop_all()
+        self.diskio.stop()
+        self.reactor.stop()
 
     def add_peer_by_info(self, peer_info):
         addr = peer_info['ip'], peer_info['port']
@@ -87,14 +125,17 @@ class PeerManager:
         peer = Peer(addr, peer_id, self.metainfo.info.num_pieces)
         conn = PeerConn(peer, sock, self.metainfo.info_hash,
             self.peer_id, self.bitfield, self.drop_connection,
-            self.update_rates, self.update_udl, self.handle_msg)
+            self.update_rates, self.update_udl, self.handle_msg,
+            self.reactor, self.connect_peer, self.diskio.full)
         with self.conns_lock:
             self.connections.append(conn)
-        threading.Thread(target=self.connect_peer, args=(conn,)).start()
+        try:
+            conn.connect()
+        except DropConnection:
+            pass
 
     def connect_peer(self, conn):
         try:
-            conn.connect()
             if conn.fastext_enabled:
                 for i in fast_allowed:
                     conn.send_fast_allowed(i)
@@ -106,14 +147,38 @@ class PeerManager:
             conn.close()
             if conn in self.connections:
                 self.connections.remove(conn)
+                self.availability.remove_bitfield(conn.peer.bitfield)
+                self.release_requests(conn.drop_requests())
+                for conns in (self.unchoked, self.peers_unchoked,
+                              self.interested, self.peers_interested):
+                    if conn in conns:
+                        conns.remove(conn)
             if not self.reannounced and len(self.connections) < 10 and \
                    self.running:
                 self.reannounced = True
                 self.reannounce()
 
+    def resume_reading(self):
+        self.reactor.call(self._resume_reading)
+
+    def _resume_reading(self):
+        with self.conns_lock:
+            conns = list(self.connections)
+        for conn in conns:
+            with conn.send_lock:
+                conn.update_events()
+
     def drop_all(self):
-        while self.connections:
-            self.drop_connection(self.connections[0])
+        with self.conns_lock:
+            conns, self.connections = self.connections, []
+            self.availability.remove_bitfields(
+                [conn.peer.bitfield for conn in conns])
+            for conn in conns:
+                conn.close()
+                self.release_requests(conn.drop_requests())
+            for conns in (self.unchoked, self.peers_unchoked,
+                          self.interested, self.peers_interested):
+                del conns[:]
 
     def handle_msg(self, conn, msg_id, *args):
         if msg_id == choke_id or msg_id == unchoke_id:
@@ -121,7 +186,11 @@ class PeerManager:
         elif msg_id == interested_id or msg_id == uninterested_id:
             self.handle_interested(conn, *args)
         elif msg_id == have_id or msg_id == bitfield_id:
+            self.update_availability(conn, msg_id, *args)
             self.update_peer_interest(conn)
+            # the full sum is only redone by update_interested
+            if msg_id == have_id and not self.bitfield[args[0]]:
+                conn.interest += self.rarity(args[0])
         elif msg_id == request_id:
             self.handle_request(conn, *args)
         elif msg_id == piece_id:
@@ -130,170 +199,387 @@ class PeerManager:
     def handle_choke(self, conn, flag):
         if not flag and not conn in self.peers_unchoked:
             self.peers_unchoked.append(conn)
+            self.request_blocks(conn)
         elif flag and conn in self.peers_unchoked:
             self.peers_unchoked.remove(conn)
+            self.release_requests(conn.drop_requests())
 
     def handle_interested(self, conn, flag):
         if flag and not conn in self.peers_interested:
             self.peers_interested.append(conn)
-        elif not flag and conn in self.peer_interested:
+        elif not flag and conn in self.peers_interested:
             self.peers_interested.remove(conn)
 
-    def update_interested(self):
-        counts = [0]*self.metainfo.info.num_pieces
+    def update_availability(self, conn, msg_id, arg):
         with self.conns_lock:
-            for conn in self.connections:
-                bf = conn.peer.bitfield
-                for i in range(len(bf)):
-                    counts[i] += bf[i]
-        rarity = []
-        i = 0
-        for n in sorted(set(counts)):
-            tier = []
-            for j in range(len(counts)):
-                if counts[j] == n:
-                    tier.append(j)
-            rarity.append(tier)
-        self._rarity = rarity
+            if conn not in self.connections:
+                return
+            if msg_id == have_id:
+                self.availability.add(arg)
+            else:
+                self.availability.remove_bitfield(arg)
+                self.availability.add_bitfield(conn.peer.bitfield)
+
+    def update_interested(self):
         with self.conns_lock:
             for conn in self.connections:
                 self.update_peer_interest(conn)
+                conn.update_interest(self.rarity)
         self.interested = sorted(self.interested, key=PeerConn.interest)
 
     def update_peer_interest(self, conn):
-        interested = False
-        for i in range(len(self.bitfield)):
-            if conn.peer.bitfield[i] and not self.bitfield[i]:
-                interested = True
+        interested = conn.peer.bitfield.any_and_not(self.bitfield)
         if interested and not conn in self.interested:
             conn.send_interested()
             self.interested.append(conn)
+            self.request_blocks(conn)
         elif not interested and conn in self.interested:
             conn.send_uninterested()
-            self.interested.pop(conn)
-        conn.update_interest(self.rarity)
+            self.interested.remove(conn)
 
     def rarity(self, index):
-        for tier in self._rarity:
-            if index in tier:
-                return self._rarity.index(tier)
+        return self.availability.rarity(index)
         
     def handle_request(self, conn, index, begin, length):
-        if not self.bitfield[index]:
+        if not 0 <= index < len(self.bitfield):
             reject = True
-        elif conn.peer.bitfield[i]:
+        elif length > max_request_size or \
+               begin + length > self.pieceio.piece_length(index):
             reject = True
-        elif peer.fastext_enabled and index in self.fast_allowed:
-            reject = False
-        elif not self.allow_transfer(conn):
+        elif not self.bitfield[index]:
+            reject = True
+        elif conn.peer.bitfield[index]:
             reject = True
+        elif conn.fastext_enabled and index in self.fast_allowed:
+            reject = False
+        else:
+            reject = not self.allow_transfer(conn)
         if reject:
             if conn.fastext_enabled:
                 conn.send_reject_request(index, begin, length)
         else:
-            threading.Thread(target=self.fulfill_request,
-                args=(conn, index, begin, length)).start()
+            self.diskio.submit(diskio.upload_priority, None,
+                self.fulfill_request, (conn, index, begin, length), False)
 
     def allow_transfer(self, conn):
-        return conn in self.peers_unchoked and conn in self.unchoked and \
-            (conn in self.peers_interested or conn in self.interested)
+        return conn in self.unchoked and conn in self.peers_interested
 
     def fulfill_request(self, conn, index, begin, length):
-        piece = self.pieceio.read_piece(index, begin, length)
-        conn.send_piece(index, begin, piece)
+        try:
+            if wire.sendfile is not None:
+                conn.send_piece_files(index, begin, length,
+                    self.pieceio.open_segments(index, begin, length),
+                    self.pieceio.files.release)
+            else:
+                conn.send_piece(index, begin,
+                    self.pieceio.read_block(index, begin, length))
+        except DropConnection:
+            pass
             
     def handle_piece(self, conn, index, begin, piece):
-        threading.Thread(target=self._handle_piece,
-            args=(conn, index, begin, piece)).start()
+        if not self.valid_block(index, begin, len(piece)):
+            self.update_udl(wasted=len(piece))
+            return
+        self.diskio.submit(diskio.write_priority, index, self._handle_piece,
+            (conn, index, begin, piece), False)
+
+    def valid_block(self, index, begin, length):
+        # only whole blocks as we request them can be written
+        if not 0 <= index < len(self.pieces) or begin % block_size:
+            return False
+        piece_length = self.pieceio.piece_length(index)
+        return begin < piece_length and \
+            length == min(block_size, piece_length - begin)
 
     def _handle_piece(self, conn, index, begin, piece):
         if self.pieces[index][begin/block_size]:
             self.update_udl(wasted=len(piece))
         else:
-            self.pieceio.write_piece(index, begin, piece)
+            self.pieceio.write_block(index, begin, piece)
             self.pieces[index][begin/block_size] = 1
+            self.picker.received(index, begin)
+            if self.endgame:
+                self.cancel_duplicates(conn, index, begin, len(piece))
             if all(self.pieces[index]):
-                if not self.piece_completed(index):
-                    self.pieces[index] = [0]*self.num_blocks
-                else:
-                    with self.conns_lock:
-                        for conn in self.connections:
-                            if conn.connected:
-                                conn.send_have(index)
+                self.diskio.submit(diskio.hash_priority, index,
+                    self.check_piece, (index,), False)
+        try:
+            self.request_blocks(conn)
+        except DropConnection:
+            pass
+
+    def check_piece(self, index):
+        if not self.piece_completed(index):
+            self.pieces[index] = [0]*self.picker.num_blocks(index)
+            self.picker.failed(index)
+        else:
+            self.picker.completed(index)
+            self.availability.have(index)
+            with self.conns_lock:
+                for other in self.connections:
+                    if other.connected:
+                        try:
+                            other.send_have(index)
+                        except DropConnection:
+                            pass
 
     def unchoker(self):
         counter = 0
         while self.running:
             self.update_interested()
-            # evaluate uloaders/dloaders
-            if not counter:
-                pass # optimistic unchoke
-            counter = (counter + 1) % 3
-            time.sleep(10)
+            self.rechoke(not counter)
+            counter = (counter + 1) % optimistic_rounds
+            time.sleep(choke_interval)
+
+    def rechoke(self, rotate=False):
+        # under the lock so that drop_connection cannot take a peer out of
+        # unchoked while we are going through it
+        with self.conns_lock:
+            candidates = [conn for conn in self.connections
+                          if conn.connected and conn in self.peers_interested]
+            # reward the peers that give us the most, or when seeding the ones
+            # that take the most
+            if self.bitfield.all():
+                rate = lambda conn: conn.ud_rates.up_avg()
+            else:
+                rate = lambda conn: conn.ud_rates.down_avg()
+            candidates.sort(key=rate, reverse=True)
+            keep = candidates[:max(self.upload_slots - 1, 0)]
+            if rotate or self.optimistic not in candidates or \
+                   self.optimistic in keep:
+                others = [conn for conn in candidates if conn not in keep]
+                self.optimistic = random.choice(others) if others else None
+            if self.optimistic is not None:
+                keep.append(self.optimistic)
+            for conn in list(self.unchoked):
+                if conn not in keep:
+                    self.choke_peer(conn)
+            for conn in keep:
+                if conn not in self.unchoked:
+                    self.unchoke_peer(conn)
 
     def choke_peer(self, conn):
-        conn.send_choke()
-        self.unchoked.remove(conn)
+        if conn in self.unchoked:
+            self.unchoked.remove(conn)
+        try:
+            conn.send_choke()
+        except DropConnection:
+            pass
         
     def unchoke_peer(self, conn):
-        conn.send_unchoke()
+        try:
+            conn.send_unchoke()
+        except DropConnection:
+            return
         self.unchoked.append(conn)
 
     def requester(self):
-        pass # decides when/how/what pieces to request
+        while self.running:
+            with self.conns_lock:
+                conns = list(self.connections)
+            self.endgame = self.picker.endgame()
+            for conn in conns:
+                try:
+                    self.release_requests(
+                        conn.expire_requests(request_timeout))
+                    self.request_blocks(conn)
+                except DropConnection:
+                    pass
+            time.sleep(1)
+
+    def release_requests(self, requests):
+        for index, begin, length in requests:
+            if self.endgame and self.requested_elsewhere(None, index, begin):
+                continue
+            self.picker.release(index, begin, length)
+
+    def requested_elsewhere(self, conn, index, begin):
+        for other in list(self.connections):
+            if other is not conn and other.queue.has(index, begin):
+                return True
+        return False
+
+    def request_blocks(self, conn):
+        if conn.choked or not conn in self.interested:
+            return
+        space = conn.queue.space()
+        if space <= 0:
+            return
+        requests = self.picker.pick(conn.peer.bitfield, space)
+        if not requests and self.picker.endgame():
+            self.endgame = True
+            requests = [req for req in self.picker.outstanding()
+                        if conn.peer.bitfield[req[0]] and
+                        not conn.queue.has(req[0], req[1])]
+            random.shuffle(requests)
+            requests = requests[:space]
+        for index, begin, length in requests:
+            conn.send_request(index, begin, length)
+
+    def cancel_duplicates(self, conn, index, begin, length):
+        for other in list(self.connections):
+            if other is not conn and other.queue.has(index, begin):
+                try:
+                    other.cancel_request(index, begin, length)
+                except DropConnection:
+                    pass
 
     def tick_rates(self):
         with self.conns_lock:
             for conn in self.connections:
                 conn.tick_rates()
 
+    def diskio_stats(self):
+        return self.diskio.stats()
+
+    def pipeline_stats(self):
+        with self.conns_lock:
+            return dict((conn.peer.addr, conn.pipeline.stats())
+                        for conn in self.connections)
+
 
 class PeerConn:
 
     def __init__(self, peer, sock, info_hash, peer_id, bitfield,
-                 disconnect, update_rates, update_udl, handle_msg):
+                 disconnect, update_rates, update_udl, handle_msg,
+                 reactor, on_connect, throttled):
         self.peer = peer
         self.sock = sock
+        self.fd = None
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.bitfield = bitfield
         self._disconnect = disconnect
         self._update_rates = update_rates
         self.ud_rates = rates.TransferRates(20)
+        self.pipeline = rates.RequestPipeline(block_size, min_queue_size,
+            max_queue_size)
         self.queue = RequestQueue(self._send_request)
         self.update_udl = update_udl
         self.handle_msg = handle_msg
+        self.reactor = reactor
+        self.on_connect = on_connect
+        self.throttled = throttled
         self.interest = 0
+        self.choked = True
+        self.running = True
+        self.connecting = False
+        self.handshake_sent = False
+        self.handshake_received = False
         self.connected = False
+        self.reader = wire.MessageReader(max(max_message_size,
+                                             self.bitfield.num_bytes + 1))
+        self.writer = wire.MessageWriter()
+        self.events = 0
+        self.flush_scheduled = False
+        self.send_lock = threading.Lock()
 
     def update_interest(self, rarity):
         interest = 0
-        for i in range(len(self.peer.bitfield)):
-            if self.peer.bitfield[i] and not self.bitfield[i]:
-                interest += rarity(i)
+        for i in self.peer.bitfield.and_not(self.bitfield).set_bits():
+            interest += rarity(i)
         self.interest = interest
 
     def interest(self):
         return self.interest
 
-    def _recv(self, size):
-        data = self.sock.recv(size)
-        self.update_rates(down=len(data))
-        return data
+    def fileno(self):
+        return self.fd
+
+    def send(self, *parts):
+        with self.send_lock:
+            if not self.running:
+                raise DropConnection
+            self.writer.write(*parts)
+            schedule = self.handshake_sent and not self.flush_scheduled
+            if schedule:
+                self.flush_scheduled = True
+        if schedule:
+            self.reactor.call(self.flush)
+        self.update_rates(up=sum(len(data) for data in parts))
 
-    def recv(self, size):
-        data = self._recv(size)
-        while len(data) != size:
-            data += self._recv(size - len(data))
-        return data
+    def flush(self):
+        # runs in the reactor, so everything queued during one pass of
+        # the loop goes out in as few writes as possible
+        try:
+            with self.send_lock:
+                self.flush_scheduled = False
+                ok = self._flush()
+            if not ok:
+                self.disconnect()
+        except DropConnection:
+            pass
 
-    def send(self, data):
+    def _flush(self):
+        if self.fd is None or not self.running:
+            return True
+        try:
+            self.writer.flush(self.sock)
+        except EnvironmentError as err:
+            if err.args[0] not in reactor.would_block:
+                return False
+        self.update_events()
+        return True
+
+    def update_events(self):
+        if self.fd is None or not self.running or self.connecting:
+            return
+        events = 0
+        if self.writer.size < max_send_buffer and not self.throttled():
+            # stop reading from a peer that does not take what we send,
+            # and from everyone while the disk queue is full
+            events |= reactor.READ
+        if self.writer.size:
+            events |= reactor.WRITE
+        if events != self.events:
+            self.events = events
+            self.reactor.modify(self, events)
+
+    def handle_write(self):
         try:
-            self.sock.send(data)
+            if self.connecting:
+                self.finish_connect()
+            else:
+                with self.send_lock:
+                    ok = self._flush()
+                if not ok:
+                    self.disconnect()
+        except DropConnection:
+            pass
+
+    def handle_read(self):
+        try:
+            self.read_msgs()
+            with self.send_lock:
+                self.update_events()
+        except DropConnection:
+            pass
+
+    def read_msgs(self):
+        try:
+            received = self.reader.recv_into(self.sock)
         except socket.error as err:
-            if err.errno == 10054:
-                self.disconnect()
-        self.update_rates(up=len(data))
+            if err.args[0] in reactor.would_block:
+                return
+            self.disconnect()
+        if not received:
+            self.disconnect()
+        self.update_rates(down=received)
+        if not self.handshake_received:
+            handshake = self.reader.take(68)
+            if handshake is None:
+                return
+            self.recv_handshake(handshake)
+            if not self.handshake_sent:
+                self.send_handshake()
+            self.handshake_done()
+        try:
+            for msg in self.reader.messages():
+                if not self.running:
+                    break
+                self.recv_msg(msg)
+        except ValueError:
+            self.disconnect()
 
     def update_rates(self, up=0, down=0):
         self.ud_rates.update(up, down)
@@ -301,40 +587,56 @@ class PeerConn:
 
     def tick_rates(self):
         self.ud_rates.tick()
-        qsize = 2 + int(self.ud_rates.down() / 10000)
+        qsize = self.pipeline.update(self.ud_rates.down_avg(5))
         if qsize != self.queue.size:
             self.queue.resize(qsize)
 
     def connect(self):
-        try:
-            if self.sock:
-                self.recv_handshake()
-                self.send_handshake()
-            else:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect(self.peer.addr)
-                self.send_handshake()
-                self.recv_handshake()
-            if self.ltep_enabled:
-                self.send_ltep_handshake()
-            if self.fastext_enabled:
-                if all(self.bitfield):
-                    self.send_have_all()
-                elif not any(self.bitfield):
-                    self.send_have_none()
-            elif any(self.bitfield):
-                self.send_bitfield()
-        except socket.error:
+        if self.sock:
+            self.sock.setblocking(False)
+            self.reactor.call(self.register, reactor.READ)
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.connecting = True
+        err = self.sock.connect_ex(self.peer.addr)
+        if err and err not in reactor.would_block:
+            self.disconnect()
+        self.reactor.call(self.register, reactor.WRITE)
+
+    def register(self, events):
+        if not self.running:
+            return
+        self.fd = self.sock.fileno()
+        self.events = events
+        self.reactor.register(self, events)
+
+    def finish_connect(self):
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
             self.disconnect()
+        self.connecting = False
+        self.update_events()
+        self.send_handshake()
+
+    def handshake_done(self):
         self.connected = True
-        threading.Thread(target=self.recv_loop).start()
+        if self.ltep_enabled:
+            self.send_ltep_handshake()
+        if self.fastext_enabled:
+            if self.bitfield.all():
+                self.send_have_all()
+            elif not self.bitfield.any():
+                self.send_have_none()
+        elif self.bitfield.any():
+            self.send_bitfield()
+        self.on_connect(self)
 
     def disconnect(self):
         self._disconnect(self)
         raise DropConnection
 
-    def recv_handshake(self):
-        handshake = self.recv(68)
+    def recv_handshake(self, handshake):
+        self.handshake_received = True
         if handshake[:20] != handshake_protocol:
             self.disconnect()
         elif handshake[28:48] != self.info_hash:
@@ -349,35 +651,32 @@ class PeerConn:
         self.fastext_enabled = ord(reserved[7]) & 0x04 and False
 
     def send_handshake(self):
-        self.send(handshake_protocol)
-        self.send(reserved_bits)
-        self.send(self.info_hash)
-        self.send(self.peer_id)
+        handshake = handshake_protocol + reserved_bits + self.info_hash + \
+            self.peer_id
+        with self.send_lock:
+            # anything queued while connecting has to go after the handshake
+            self.writer.prepend(handshake)
+            self.handshake_sent = True
+            ok = self._flush()
+        if not ok:
+            self.disconnect()
+        self.update_rates(up=len(handshake))
 
-    def recv_loop(self):
-        self.running = True
-        while self.running:
-            try:
-                select.select([self.sock], [], [])
-                self.recv_msg()
-            except DropConnection:
-                break
-        self.sock.close()
-
-    def recv_msg(self):
+    def recv_msg(self, msg):
         try:
-            length, = struct.unpack('!I', self.recv(4))
-            if not length:
+            if not msg:
                 print 'msg received: keep alive\n',
                 return
-            msg_id = ord(self.recv(1))
+            msg_id = ord(msg[0])
             if msg_id not in [4, 5]:
                 try:
                     print 'msg received: %s\n'% names[msg_id],
                 except IndexError:
                     print msg_id
-            if length > 1:
-                payload = self.recv(length - 1)
+            payload = msg[1:]
+            if msg_id != piece_id or len(msg) <= self.reader.large:
+                # only large messages come in a buffer of their own
+                payload = payload.tobytes()
             if msg_id == choke_id:
                 self.handle_choke()
             elif msg_id == unchoke_id:
@@ -430,26 +729,30 @@ class PeerConn:
     def handle_have(self, payload):
         index, = struct.unpack('!I', payload)
         try:
+            if self.peer.bitfield[index]:
+                return
             self.peer.bitfield[index] = 1
-            self.handle_msg(self, have_id, False)
         except IndexError:
             self.disconnect()
+        self.handle_msg(self, have_id, index)
 
     def handle_bitfield(self, payload):
         try:
-            self.peer.bitfield.unpack(payload)
-            self.handle_msg(self, bitfield_id, False)
+            bf = bitfield.Bitfield(len(self.peer.bitfield), payload)
         except ValueError:
             self.disconnect()
+        old, self.peer.bitfield = self.peer.bitfield, bf
+        self.handle_msg(self, bitfield_id, old)
 
     def handle_request(self, payload):
         index, begin, length = struct.unpack('!III', payload)
         self.handle_msg(self, request_id, index, begin, length)
 
     def handle_piece(self, payload):
-        index, begin = struct.unpack('!II', payload[:8])
+        index, begin = struct.unpack_from('!II', payload)
         piece = payload[8:]
         self.update_udl(down=len(piece))
+        self.pipeline.arrived((index, begin), len(piece))
         self.queue.pop(index, begin)
         self.handle_msg(self, piece_id, index, begin, piece)
         
@@ -459,48 +762,33 @@ class PeerConn:
     def handle_ltep(self, payload):
         pass
 
-    def send_int(self, i):
-        self.send(struct.pack('!I', i))
-
     def send_choke(self):
-        self.send_int(1)
-        self.send(chr(choke_id))
+        self.send(wire.header.pack(1, choke_id))
 
     def send_unchoke(self):
-        self.send_int(1)
-        self.send(chr(unchoke_id))
+        self.send(wire.header.pack(1, unchoke_id))
 
     def send_interested(self):
-        self.send_int(1)
-        self.send(chr(interested_id))
+        self.send(wire.header.pack(1, interested_id))
 
     def send_uninterested(self):
-        self.send_int(1)
-        self.send(chr(uninterested_id))
+        self.send(wire.header.pack(1, uninterested_id))
 
     def send_have(self, index):
-        self.send_int(5)
-        self.send(chr(have_id))
-        self.send_int(index)
+        self.send(wire.index_msg.pack(5, have_id, index))
 
     def send_bitfield(self, bs=None):
         if bs is None:
             bs = self.bitfield.pack()
-        self.send_int(1 + len(bs))
-        self.send(chr(bitfield_id))
-        self.send(bs)
+        self.send(wire.header.pack(1 + len(bs), bitfield_id), bs)
 
     def send_lazy_bitfield(self, num_haves=20):
         bf = self.bitfield.clone()
-        pieces = range(len(bf))
-        random.shuffle(pieces)
-        haves = []
-        for i in pieces:
-            if bf[i]:
-                bf[i] = 0
-                haves.append(i)
-                if len(haves) > num_haves:
-                    break
+        haves = list(bf.set_bits())
+        random.shuffle(haves)
+        haves = haves[:num_haves]
+        for i in haves:
+            bf[i] = 0
         self.send_bitfield(bf.pack())
         for i in haves:
             self.send_have(i)
@@ -508,52 +796,64 @@ class PeerConn:
     def send_request(self, index, begin, length):
         self.queue.push(index, begin, length)
 
+    def cancel_request(self, index, begin, length):
+        self.pipeline.forget((index, begin))
+        if self.queue.cancel(index, begin, length):
+            self.send_cancel(index, begin, length)
+
+    def expire_requests(self, timeout):
+        requests = self.queue.expire(timeout)
+        for index, begin, length in requests:
+            self.pipeline.forget((index, begin))
+            self.send_cancel(index, begin, length)
+        return requests
+
+    def drop_requests(self):
+        requests = self.queue.clear()
+        for index, begin, length in requests:
+            self.pipeline.forget((index, begin))
+        return requests
+
     def _send_request(self, index, begin, length):
-        self.send_int(13)
-        self.send(chr(request_id))
-        self.send_int(index)
-        self.send_int(begin)
-        self.send_int(length)
+        self.pipeline.sent((index, begin))
+        self.send(wire.request_msg.pack(13, request_id, index, begin, length))
 
     def send_piece(self, index, begin, piece):
-        self.send_int(9 + len(piece))
-        self.send(chr(piece_id))
-        self.send_int(index)
-        self.send_int(begin)
-        self.send(piece)
+        self.send(wire.piece_header.pack(9 + len(piece), piece_id, index,
+                                         begin), piece)
+        self.update_udl(up=len(piece))
+
+    def send_piece_files(self, index, begin, length, files, release):
+        spans = [wire.FileSpan(f.fd, offset, size, lambda f=f: release(f))
+                 for f, offset, size in files]
+        length = sum(len(span) for span in spans)
+        try:
+            self.send(wire.piece_header.pack(9 + length, piece_id, index,
+                                             begin), *spans)
+        except DropConnection:
+            for span in spans:
+                span.done()
+            raise
         self.update_udl(up=length)
 
     def send_cancel(self, index, begin, length):
-        self.send_int(13)
-        self.send(chr(cancel_id))
-        self.send_int(index)
-        self.send_int(begin)
-        self.send_int(length)
+        self.send(wire.request_msg.pack(13, cancel_id, index, begin, length))
 
     def send_suggest_piece(self, index):
-        self.send_int(5)
-        self.send(chr(suggest_piece_id))
-        self.send_int(index)
+        self.send(wire.index_msg.pack(5, suggest_piece_id, index))
 
     def send_have_all(self):
-        self.send_int(1)
-        self.send(chr(have_all_id))
+        self.send(wire.header.pack(1, have_all_id))
 
     def send_have_none(self):
-        self.send_int(1)
-        self.send(chr(have_none_id))
+        self.send(wire.header.pack(1, have_none_id))
 
     def send_reject_request(self, index, begin, length):
-        self.send_int(13)
-        self.send(chr(reject_request_id))
-        self.send_int(index)
-        self.send_int(begin)
-        self.send_int(length)
+        self.send(wire.request_msg.pack(13, reject_request_id, index, begin,
+                                        length))
 
     def send_allowed_fast(self, index):
-        self.send_int(5)
-        self.send(chr(allowed_fast_id))
-        self.send_int(index)
+        self.send(wire.index_msg.pack(5, allowed_fast_id, index))
 
     def send_ltep_handshake(self):
         pass
@@ -568,51 +868,95 @@ class PeerConn:
 
     def close(self):
         self.running = False
+        self.connected = False
+        self.reactor.call(self._close)
+
+    def _close(self):
+        self.reactor.unregister(self)
+        with self.send_lock:
+            self.writer.clear()
+        if self.sock is not None:
+            self.sock.close()
      
 
 class RequestQueue:
 
     def __init__(self, send_request):
         self.send_request = send_request
-        self.pending = []
-        self.queue = []
+        self.pending = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.queued = {}
         self.size = 2
         self.lock = threading.Lock()
 
     def push(self, index, begin, length):
         with self.lock:
-            if len(self.pending) < self.size:
-                self.send_request(index, begin, length)
-                self.pending.append((index, begin, length))
-            else:
-                self.queue.append((index, begin, length))
+            key = index, begin
+            if key in self.pending or key in self.queued:
+                return
+            self.queued[key] = length
+            self.queue.append(key)
+            self._flush()
 
     def pop(self, index, begin):
         with self.lock:
-            ret = False
-            for req in self.pending:
-                if req[:2] == (index, begin):
-                    self.pending.remove(req)
-                    ret = True
-            self.flush()
+            ret = self.pending.pop((index, begin), None) is not None
+            self._flush()
         return ret
 
-    def flush(self):
-        while len(self.pending) < self.size and self.queue:
-            req = self.queue.pop(0)
-            self.send_request(*req)
-            self.pending.append(req)
-            
+    def has(self, index, begin):
+        key = index, begin
+        return key in self.pending or key in self.queued
+
+    def space(self):
+        with self.lock:
+            return self.size - len(self.pending) - len(self.queued)
+
     def resize(self, size):
-        self.size = size
-        self.flush()
+        with self.lock:
+            self.size = size
+            self._flush()
 
     def cancel(self, index, begin, length):
         with self.lock:
-            if not self.pop(index, begin):
-                for req in self.queue:
-                    if req == (index, begin, length):
-                        self.queue.remove(req)
+            key = index, begin
+            if self.pending.pop(key, None) is not None:
+                self._flush()
+                return True
+            self.queued.pop(key, None)
+            return False
+
+    def expire(self, timeout):
+        expired = []
+        with self.lock:
+            deadline = time.time() - timeout
+            for key, (length, sent_at) in self.pending.items():
+                if sent_at > deadline:
+                    break
+                del self.pending[key]
+                expired.append(key + (length,))
+            self._flush()
+        return expired
+
+    def clear(self):
+        with self.lock:
+            requests = [key + (length,) for key, (length, sent_at)
+                        in self.pending.iteritems()]
+            requests += [key + (length,) for key, length
+                         in self.queued.iteritems()]
+            self.pending.clear()
+            self.queue.clear()
+            self.queued.clear()
+        return requests
+
+    def _flush(self):
+        while len(self.pending) < self.size and self.queue:
+            key = self.queue.popleft()
+            if key not in self.queued:
+                continue
+            length = self.queued.pop(key)
+            self.pending[key] = length, time.time()
+            self.send_request(key[0], key[1], length)
 
 
 class Peer:
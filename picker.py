@@ -0,0 +1,135 @@
+import collections
+import random
+import threading
+
+random_first = 4
+random_tries = 64
+
+
+class PiecePicker:
+
+    def __init__(self, info, total_size, bitfield, availability, block_size):
+        self.num_pieces = info.num_pieces
+        self.piece_size = info.piece_size
+        self.total_size = total_size
+        self.bitfield = bitfield
+        self.availability = availability
+        self.block_size = block_size
+        self.piece_blocks = -(-self.piece_size // block_size)
+        self.partial = collections.OrderedDict()
+        self.started = set()
+        self.requested = {}
+        self.lock = threading.Lock()
+
+    def piece_length(self, index):
+        if index == self.num_pieces - 1:
+            return self.total_size - self.piece_size * index
+        return self.piece_size
+
+    def num_blocks(self, index):
+        return -(-self.piece_length(index) // self.block_size)
+
+    def blocks(self, index):
+        length = self.piece_length(index)
+        for begin in range(0, length, self.block_size):
+            yield begin, min(self.block_size, length - begin)
+
+    def pick(self, bf, count):
+        picked = []
+        with self.lock:
+            for index in self.partial.keys():
+                if len(picked) >= count:
+                    return picked
+                if bf[index]:
+                    self._take(index, count - len(picked), picked)
+            pieces = collections.deque()
+            while len(picked) < count:
+                if not pieces:
+                    # one lookup for as many pieces as the blocks will need
+                    wanted = -(-(count - len(picked)) // self.piece_blocks)
+                    pieces.extend(self._next_pieces(bf, wanted))
+                    if not pieces:
+                        break
+                index = pieces.popleft()
+                self.started.add(index)
+                self.partial[index] = collections.deque(self.blocks(index))
+                self._take(index, count - len(picked), picked)
+        return picked
+
+    def received(self, index, begin):
+        with self.lock:
+            if self.requested.pop((index, begin), None) is not None:
+                return
+            # a block we had given up on arrived after all
+            blocks = self.partial.get(index, ())
+            for block in blocks:
+                if block[0] == begin:
+                    blocks.remove(block)
+                    if not blocks:
+                        del self.partial[index]
+                    break
+
+    def release(self, index, begin, length):
+        with self.lock:
+            if self.requested.pop((index, begin), None) is None:
+                return
+            if index not in self.partial:
+                self.partial[index] = collections.deque()
+            self.partial[index].appendleft((begin, length))
+
+    def restore(self, index, received):
+        with self.lock:
+            self.started.add(index)
+            self.partial[index] = collections.deque(block for block, flag
+                in zip(self.blocks(index), received) if not flag)
+
+    def completed(self, index):
+        with self.lock:
+            self.started.discard(index)
+            self.partial.pop(index, None)
+
+    def failed(self, index):
+        with self.lock:
+            self.partial[index] = collections.deque(self.blocks(index))
+
+    def endgame(self):
+        with self.lock:
+            return not self.partial and bool(self.requested) and \
+                len(self.started) + self.bitfield.num_true >= self.num_pieces
+
+    def outstanding(self):
+        with self.lock:
+            return [key + (length,) for key, length
+                    in self.requested.iteritems()]
+
+    def _take(self, index, count, picked):
+        blocks = self.partial[index]
+        while blocks and count:
+            begin, length = blocks.popleft()
+            self.requested[index, begin] = length
+            picked.append((index, begin, length))
+            count -= 1
+        if not blocks:
+            del self.partial[index]
+
+    def _next_pieces(self, bf, count):
+        if self.bitfield.num_true < random_first:
+            return self._random_pieces(bf, count)
+        return self.availability.rarest(bf, count, self.started)
+
+    def _random_pieces(self, bf, count):
+        # guessing is enough as long as the peer has a fair share of what
+        # we need, only fall back to listing the candidates when it is not
+        pieces = set()
+        for i in range(random_tries):
+            index = random.randrange(self.num_pieces)
+            if bf[index] and not self.bitfield[index] and \
+                   index not in self.started:
+                pieces.add(index)
+                if len(pieces) == count:
+                    break
+        if pieces:
+            return list(pieces)
+        candidates = [i for i in bf.and_not(self.bitfield).set_bits()
+                      if i not in self.started]
+        return random.sample(candidates, min(count, len(candidates)))
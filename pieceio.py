@@ -1,76 +1,204 @@
+import bisect
+import collections
+import errno
 import hashlib
-import io
+import mmap
+import multiprocessing
 import threading
 import os
+from multiprocessing.pool import ThreadPool
 
 import bitfield
 
+max_open_files = 64
+window_size = 2**26
+max_windows = 4
+flush_interval = 5
+assembly_cache_size = 2**26
+read_cache_size = 2**25
+recheck_chunk_size = 2**24
 
-def PieceIO(info, dl_dir):
+
+def PieceIO(info, dl_dir, storage='file', progress=None, cancel=None,
+            resume=None, allocation='sparse'):
     if 'length' in info:
-        self = SingleFilePieceIO(info, dl_dir)
+        self = SingleFilePieceIO(info, dl_dir, storage, allocation)
+    else:
+        self =  MultiFilePieceIO(info, dl_dir, storage, allocation)
+    if resume is not None:
+        self.resume(resume, progress=progress, cancel=cancel)
     else:
-        self =  MultiFilePieceIO(info, dl_dir)
-    self.create_bitfield()
+        self.create_bitfield(progress=progress, cancel=cancel)
     return self
 
 
 class BasePieceIO:
 
-    def __init__(self, info, dl_dir):
+    def __init__(self, info, dl_dir, storage='file', allocation='sparse'):
         self.info = info
         self.dl_dir = dl_dir
-        self.locks = {}
+        self.files = storages[storage](max_open_files, allocation)
+        self.cache = AssemblyCache(self, assembly_cache_size)
+        self.read_cache = ReadCache(self, read_cache_size)
+        self.hashers = {}
+        self.hash_lock = threading.Lock()
+        self.resume_blocks = {}
 
     def read_piece(self, index, begin, length, create=False):
-        buf = io.BytesIO()
-        self.handle_piece(index, begin, length, buf, True, create)
-        buf.seek(0)
-        return buf.read()
+        chunks = []
+        self.handle_piece(index, begin, length, chunks, True, create)
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(_bytes(chunk) for chunk in chunks)
         
+    def read_block(self, index, begin, length):
+        if not self.bitfield[index]:
+            return self.read_piece(index, begin, length)
+        return self.read_cache.read(index, begin, length)
+
+    def open_segments(self, index, begin, length):
+        # the files stay open until every one of them is released
+        opened = []
+        try:
+            for path, offset, size, flen in self.segments(index, begin,
+                                                          length):
+                opened.append((self.files.acquire(path, flen), offset, size))
+        except (EnvironmentError, PieceIOError):
+            for f, offset, size in opened:
+                self.files.release(f)
+            raise
+        return opened
+
     def write_piece(self, index, begin, data, create=False):
-        buf = io.BytesIO(data)
-        return self.handle_piece(index, begin, len(data), buf, False, create)
+        return self.handle_piece(index, begin, len(data), data, False, create)
 
     def handle_piece(self, index, begin, length, buf, read, create):
-        end = begin + length
-        while begin < end:
+        pos = 0
+        for path, offset, size, flen in self.segments(index, begin, length):
+            f = self.files.acquire(path, flen, create)
             try:
-                path, offset, flen = self.position(index, begin)
-            except EndReachedException:
-                break
-            size = min(flen - offset, end - begin)
-            dirs = os.path.dirname(path)
-            if not os.path.exists(dirs):
-                if not create:
-                    raise FileMissingError, path
-                os.makedirs(dirs)
-            with self.locks[path]:
-                if not os.path.exists(path):
-                    if not create:
-                        raise FileMissingError, path
-                    fd = open(path, 'w+b')
-                    fd.seek(flen - 1)
-                    fd.write(chr(0))
-                else:
-                    fd = open(path, 'r+b')
-                fd.seek(offset)
                 if read:
-                    data = fd.read(size)
-                    buf.write(data)
+                    buf.append(f.read(offset, size))
                 else:
-                    data = buf.read(size)
-                    fd.write(data)
-                fd.close()
-            begin += size
+                    f.write(offset, buf[pos:pos + size])
+            finally:
+                self.files.release(f)
+            pos += size
         return length
 
-    def create_bitfield(self):
+    def write_block(self, index, begin, data):
+        self.cache.add(index, begin, data)
+
+    def write_through(self, index, begin, data):
+        self.write_piece(index, begin, data)
+        with self.hash_lock:
+            state = self.hashers.get(index)
+            if state is None and not begin:
+                state = self.hashers[index] = [hashlib.sha1(), 0]
+            if state is None:
+                return
+            elif begin == state[1]:
+                state[0].update(data)
+                state[1] += len(data)
+            elif begin < state[1]:
+                # hashed bytes were overwritten, start over from disk
+                del self.hashers[index]
+
+    def close(self):
+        self.cache.flush()
+        self.files.close()
+
+    def create_bitfield(self, workers=None, progress=None, cancel=None):
         self.bitfield = bitfield.Bitfield(self.info.num_pieces)
-        for i in range(self.info.num_pieces):
-            self.verify_piece(i, False)
+        return self.recheck(range(self.info.num_pieces), workers, progress,
+            cancel)
+
+    def resume(self, record, workers=None, progress=None, cancel=None):
+        stats = self.file_stats()
+        try:
+            if len(record['files']) != len(stats):
+                raise ValueError
+            self.bitfield = bitfield.Bitfield(self.info.num_pieces,
+                                              record['bitfield'])
+        except ValueError:
+            return self.create_bitfield(workers, progress, cancel)
+        changed = set()
+        offset = 0
+        for (path, length), old, new in zip(self.file_list(),
+                                            record['files'], stats):
+            if old != new and length:
+                changed.update(range(offset / self.info.piece_size,
+                    (offset + length - 1) / self.info.piece_size + 1))
+            offset += length
+        for index in changed:
+            self.bitfield[index] = 0
+        self.resume_blocks = dict((index, blocks)
+            for index, blocks in record['blocks']
+            if index not in changed and 0 <= index < self.info.num_pieces
+            and not self.bitfield[index])
+        return self.recheck(changed, workers, progress, cancel)
+
+    def file_stats(self):
+        stats = []
+        for path, length in self.file_list():
+            try:
+                st = os.stat(path)
+                stats.append([st.st_size, int(st.st_mtime * 10**6)])
+            except OSError:
+                stats.append([-1, -1])
+        return stats
+
+    def recheck(self, pieces, workers=None, progress=None, cancel=None):
+        pieces = sorted(pieces)
+        run = max(1, recheck_chunk_size / self.info.piece_size)
+        runs = [pieces[i:i+run] for i in range(0, len(pieces), run)]
+        if not runs:
+            return True
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool = ThreadPool(min(workers, len(runs)))
+        done = 0
+        try:
+            for results in pool.imap_unordered(
+                    lambda run: self._check_run(run, cancel), runs):
+                for index, ok in results:
+                    self.bitfield[index] = ok
+                done += len(results)
+                if progress is not None:
+                    progress(done, len(pieces))
+                if cancel is not None and cancel.is_set():
+                    return False
+        finally:
+            pool.terminate()
+        return True
+
+    def _check_run(self, run, cancel):
+        results = []
+        start = 0
+        while start < len(run) and not (cancel and cancel.is_set()):
+            end = start + 1
+            while end < len(run) and run[end] == run[end - 1] + 1:
+                end += 1
+            lengths = [self.piece_length(i) for i in run[start:end]]
+            data = memoryview(self.read_piece(run[start], 0, sum(lengths),
+                                              True))
+            pos = 0
+            for index, length in zip(run[start:end], lengths):
+                digest = hashlib.sha1(data[pos:pos + length]).digest()
+                results.append((index, int(digest == self.info.pieces[index])))
+                pos += length
+            start = end
+        return results
 
     def verify_piece(self, index, clear=True):
+        data = self.cache.take(index, self.piece_length(index))
+        if data is not None:
+            # assembled in memory: only write it out if it checks out
+            if hashlib.sha1(data).digest() != self.info.pieces[index]:
+                return False
+            self.write_piece(index, 0, data)
+            self.bitfield[index] = 1
+            return True
         if self.verify_hash(index):
             self.bitfield[index] = 1
             return True
@@ -79,33 +207,41 @@ class BasePieceIO:
         return False
 
     def verify_hash(self, index):
-        sha1 = hashlib.sha1()
-        data = self.read_piece(index, 0, self.info.piece_size, True)
-        sha1.update(data)
+        with self.hash_lock:
+            sha1, pos = self.hashers.pop(index, (hashlib.sha1(), 0))
+        length = self.piece_length(index)
+        if pos < length:
+            sha1.update(self.read_piece(index, pos, length - pos, True))
         return sha1.digest() == self.info.pieces[index]
 
+    def piece_length(self, index):
+        if index == self.info.num_pieces - 1:
+            return self.total_size - self.info.piece_size * index
+        return self.info.piece_size
+
     def clear_piece(self, index):
-        data = chr(0)*self.info.piece_size
-        self.write_piece(index, 0, data)
+        # the bad data is simply overwritten when the piece is downloaded again
+        with self.hash_lock:
+            self.hashers.pop(index, None)
 
     def data_left(self):
-        left = self.total_size
-        for bit in self.bitfield[:-1]:
-            if bit:
-                left -= self.info.piece_size
+        done = self.bitfield.num_true * self.info.piece_size
         if self.bitfield[-1]:
-            left -= self.total_size % self.info.piece_size
-        return left
+            done -= self.info.num_pieces * self.info.piece_size - \
+                self.total_size
+        return self.total_size - done
     
 
 class SingleFilePieceIO(BasePieceIO):
 
-    def __init__(self, info, dl_dir):
-        BasePieceIO.__init__(self, info, dl_dir)
+    def __init__(self, info, dl_dir, storage='file', allocation='sparse'):
+        BasePieceIO.__init__(self, info, dl_dir, storage, allocation)
         self.path = self.dl_dir + [self.info['name']]
         self.path = os.path.join(*self.path)
-        self.locks[self.path] = threading.Lock()
         self.total_size = self.info['length']
+
+    def file_list(self):
+        return [(self.path, self.info['length'])]
     
     def position(self, index, begin):
         offset = index * self.info.piece_size + begin
@@ -113,44 +249,425 @@ class SingleFilePieceIO(BasePieceIO):
             raise EndReachedException
         return self.path, offset, self.info['length']
 
+    def segments(self, index, begin, length):
+        offset = index * self.info.piece_size + begin
+        size = min(length, self.total_size - offset)
+        if size <= 0:
+            return []
+        return [(self.path, offset, size, self.total_size)]
+
 
 class MultiFilePieceIO(BasePieceIO):
 
-    def __init__(self, info, dl_dir):
-        BasePieceIO.__init__(self, info, dl_dir)
-        self.dl_dir += [self.info['name']]
-        self._mapping = [(0, 0)]
+    def __init__(self, info, dl_dir, storage='file', allocation='sparse'):
+        BasePieceIO.__init__(self, info, dl_dir, storage, allocation)
+        self.dl_dir = self.dl_dir + [self.info['name']]
+        self.paths = []
+        self.lengths = []
+        self.offsets = []
         self.total_size = 0
-        index = 0
-        for i in range(len(self.info['files'])):
-            f = self.info['files'][i]
-            index += f['length']
+        for f in self.info['files']:
+            self.paths.append(os.path.join(*(self.dl_dir + list(f['path']))))
+            self.lengths.append(f['length'])
+            self.offsets.append(self.total_size)
             self.total_size += f['length']
-            while index >= self.info.piece_size:
-                offset = self.info.piece_size - (index - f['length'])
-                self._mapping.append((i, offset))
-                index -= self.info.piece_size
 
     def mapping(self, index, begin):
-        files = self.info['files']
-        i, offset = self._mapping[index]
-        offset += begin
-        try:
-            while offset >= files[i]['length']:
-                offset -= files[i]['length']
-                i += 1
-        except IndexError:
+        offset = index * self.info.piece_size + begin
+        if offset >= self.total_size:
             raise EndReachedException
-        return i, offset
+        # zero length files share their offset with the next file, so take
+        # the last file starting at or before the offset
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        return i, offset - self.offsets[i]
+
+    def file_list(self):
+        return zip(self.paths, self.lengths)
 
     def position(self, index, begin):
         i, offset = self.mapping(index, begin)
-        f = self.info['files'][i]
-        path = self.dl_dir + f['path']
-        path = os.path.join(*path)
-        if not path in self.locks:
-            self.locks[path] = threading.Lock()
-        return path, offset, f['length']
+        return self.paths[i], offset, self.lengths[i]
+
+    def segments(self, index, begin, length):
+        start = index * self.info.piece_size + begin
+        end = min(start + length, self.total_size)
+        segments = []
+        if start >= end:
+            return segments
+        i = bisect.bisect_right(self.offsets, start) - 1
+        while start < end:
+            offset = start - self.offsets[i]
+            size = min(self.lengths[i] - offset, end - start)
+            if size > 0:
+                segments.append((self.paths[i], offset, size,
+                                 self.lengths[i]))
+                start += size
+            i += 1
+        return segments
+
+
+class FileCache:
+
+    def __init__(self, size, allocation='sparse'):
+        if allocation not in allocations:
+            raise ValueError, 'unknown allocation policy %r' % allocation
+        self.size = size
+        self.allocation = allocation
+        self.files = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, path, flen, create=False):
+        with self.lock:
+            f = self.files.pop(path, None)
+            if f is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                f = self.open(path, flen, create)
+                while len(self.files) >= self.size:
+                    nil, old = self.files.popitem(False)
+                    old.evicted = True
+                    if not old.users:
+                        old.close()
+            self.files[path] = f
+            f.users += 1
+            return f
+
+    def open(self, path, flen, create):
+        return OpenFile(path, flen, create, self.allocation)
+
+    def release(self, f):
+        with self.lock:
+            f.users -= 1
+            if f.evicted and not f.users:
+                f.close()
+
+    def close(self):
+        with self.lock:
+            while self.files:
+                nil, f = self.files.popitem()
+                f.evicted = True
+                if not f.users:
+                    f.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'open': len(self.files),
+            }
+
+
+class OpenFile:
+
+    def __init__(self, path, flen, create=False, allocation='sparse'):
+        flags = os.O_RDWR | getattr(os, 'O_BINARY', 0)
+        try:
+            self.fd = os.open(path, flags)
+        except OSError as err:
+            if err.errno != errno.ENOENT or not create:
+                raise FileMissingError, path
+            dirs = os.path.dirname(path)
+            if dirs and not os.path.exists(dirs):
+                os.makedirs(dirs)
+            self.fd = os.open(path, flags | os.O_CREAT)
+            allocate(self.fd, flen, allocation)
+        self.path = path
+        self.users = 0
+        self.evicted = False
+        # only needed where os.pread/os.pwrite are missing
+        self.lock = threading.Lock()
+
+    def read(self, offset, size):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            chunks = []
+            while size:
+                data = os.read(self.fd, size)
+                if not data:
+                    break
+                chunks.append(data)
+                size -= len(data)
+            return ''.join(chunks)
+
+    def write(self, offset, data):
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(self.fd, data, offset)
+                data = data[written:]
+                offset += written
+            return
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MmapCache(FileCache):
+
+    def __init__(self, size, allocation='sparse'):
+        FileCache.__init__(self, size, allocation)
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def open(self, path, flen, create):
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_loop)
+            self.flusher.daemon = True
+            self.flusher.start()
+        return MappedFile(path, flen, create, self.allocation)
+
+    def flush_loop(self):
+        while not self.stopped.wait(flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            files = self.files.values()
+        for f in files:
+            f.flush()
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        FileCache.close(self)
+
+
+class MappedFile(OpenFile):
+
+    def __init__(self, path, flen, create=False, allocation='sparse'):
+        OpenFile.__init__(self, path, flen, create, allocation)
+        self.size = os.fstat(self.fd).st_size
+        self.windows = collections.OrderedDict()
+        self.dirty = set()
+
+    def read(self, offset, size):
+        chunks = []
+        end = min(offset + size, self.size)
+        with self.lock:
+            while offset < end:
+                start, mm = self.window(offset)
+                size = min(end, start + len(mm)) - offset
+                chunks.append(memoryview(buffer(mm, offset - start, size)))
+                offset += size
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(chunk.tobytes() for chunk in chunks)
+
+    def write(self, offset, data):
+        data = _bytes(data)
+        end = offset + len(data)
+        with self.lock:
+            if end > self.size:
+                os.lseek(self.fd, end - 1, os.SEEK_SET)
+                os.write(self.fd, chr(0))
+                self.size = end
+                # the last window was mapped short of the new end
+                for start, mm in self.windows.items():
+                    if len(mm) < window_size:
+                        self.unmap(start)
+            pos = 0
+            while offset < end:
+                start, mm = self.window(offset)
+                size = min(end, start + len(mm)) - offset
+                mm[offset - start:offset - start + size] = data[pos:pos + size]
+                self.dirty.add(start)
+                offset += size
+                pos += size
+
+    def window(self, offset):
+        start = offset - offset % window_size
+        mm = self.windows.pop(start, None)
+        if mm is None:
+            while len(self.windows) >= max_windows:
+                self.unmap(next(iter(self.windows)))
+            length = min(window_size, self.size - start)
+            mm = mmap.mmap(self.fd, length, offset=start)
+        self.windows[start] = mm
+        return start, mm
+
+    def unmap(self, start):
+        # readers may still hold buffers into the map, so it is left for
+        # the garbage collector to unmap rather than closed here
+        mm = self.windows.pop(start)
+        if start in self.dirty:
+            self.dirty.discard(start)
+            mm.flush()
+
+    def flush(self):
+        with self.lock:
+            dirty = [self.windows[start] for start in self.dirty]
+            self.dirty.clear()
+        for mm in dirty:
+            mm.flush()
+
+    def close(self):
+        with self.lock:
+            while self.windows:
+                self.unmap(next(iter(self.windows)))
+        os.close(self.fd)
+
+
+class AssemblyCache:
+
+    def __init__(self, pieceio, limit):
+        self.pieceio = pieceio
+        self.limit = limit
+        self.size = 0
+        self.pieces = collections.OrderedDict()
+        self.spilled = set()
+        # blocks are written out after the lock is released, writing
+        # counts the pieces that still have such writes under way
+        self.writing = collections.Counter()
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+
+    def add(self, index, begin, data):
+        spills = []
+        with self.lock:
+            if index in self.spilled or len(data) > self.limit:
+                self.writing[index] += 1
+                spills.append((index, {begin: data}))
+            else:
+                blocks = self.pieces.pop(index, {})
+                if begin in blocks:
+                    self.size -= len(blocks[begin])
+                blocks[begin] = data
+                self.pieces[index] = blocks
+                self.size += len(data)
+                while self.size > self.limit:
+                    spills.append(self._spill(next(iter(self.pieces))))
+        self._write(spills)
+
+    def take(self, index, length):
+        with self.lock:
+            # a piece read back from disk must have all of its blocks there
+            while self.writing[index]:
+                self.written.wait()
+            blocks = self.pieces.pop(index, {})
+            spilled = index in self.spilled
+            self.spilled.discard(index)
+            size = sum(len(data) for data in blocks.itervalues())
+            self.size -= size
+            if not spilled and size == length and blocks:
+                return ''.join(_bytes(blocks[begin])
+                               for begin in sorted(blocks))
+        for begin in sorted(blocks):
+            self.pieceio.write_through(index, begin, blocks[begin])
+        return None
+
+    def cached(self):
+        with self.lock:
+            return set(self.pieces)
+
+    def flush(self):
+        with self.lock:
+            spills = [self._spill(index) for index in list(self.pieces)]
+        self._write(spills)
+
+    def _spill(self, index):
+        # marked spilled right away so that later blocks go to disk too
+        blocks = self.pieces.pop(index)
+        self.size -= sum(len(data) for data in blocks.itervalues())
+        self.spilled.add(index)
+        self.writing[index] += 1
+        return index, blocks
+
+    def _write(self, spills):
+        try:
+            for index, blocks in spills:
+                for begin in sorted(blocks):
+                    self.pieceio.write_through(index, begin, blocks[begin])
+        finally:
+            with self.lock:
+                for index, blocks in spills:
+                    self.writing[index] -= 1
+                    if not self.writing[index]:
+                        del self.writing[index]
+                self.written.notify_all()
+
+
+class ReadCache:
+
+    def __init__(self, pieceio, limit):
+        self.pieceio = pieceio
+        self.limit = limit
+        self.size = 0
+        self.pieces = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def read(self, index, begin, length):
+        with self.lock:
+            data = self.pieces.pop(index, None)
+            if data is not None:
+                self.hits += 1
+                self.pieces[index] = data
+            else:
+                self.misses += 1
+        if data is None:
+            # peers tend to request a piece block by block, read it all
+            data = _bytes(self.pieceio.read_piece(index, 0,
+                self.pieceio.piece_length(index)))
+            with self.lock:
+                if index not in self.pieces and len(data) <= self.limit:
+                    self.pieces[index] = data
+                    self.size += len(data)
+                    while self.size > self.limit:
+                        self.size -= len(self.pieces.popitem(False)[1])
+        return buffer(data, begin, length)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit rate': float(self.hits) / total if total else 0.0,
+                'size': self.size,
+                'pieces': len(self.pieces),
+            }
+
+
+def allocate(fd, flen, allocation):
+    if not flen or allocation == 'none':
+        return
+    elif allocation == 'full':
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                return os.posix_fallocate(fd, 0, flen)
+            except OSError as err:
+                if err.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        zeros = chr(0) * 2**20
+        os.lseek(fd, 0, os.SEEK_SET)
+        left = flen
+        while left:
+            left -= os.write(fd, zeros[:left])
+    else:
+        os.ftruncate(fd, flen)
+
+def _bytes(data):
+    if isinstance(data, str):
+        return data
+    return memoryview(data).tobytes()
+
+allocations = ('sparse', 'full', 'none')
+
+storages = {
+    'file': FileCache,
+    'mmap': MmapCache,
+}
 
 
 class PieceIOError(Exception):
@@ -1,4 +1,5 @@
 import threading
+import time
 
 class TransferRates:
 
@@ -39,3 +40,64 @@ class TransferRates:
             self.window.pop(0)
             self.window.append(self.count)
             self.count = [0, 0]
+
+
+class RequestPipeline:
+
+    def __init__(self, block_size, min_size, max_size, headroom=2.0):
+        self.block_size = block_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.headroom = headroom
+        self.size = min_size
+        self.rate = 0.0
+        self.rtt = None
+        self.rttvar = 0.0
+        self.received = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def sent(self, key):
+        with self.lock:
+            self.inflight[key] = time.time(), self.received
+
+    def forget(self, key):
+        with self.lock:
+            self.inflight.pop(key, None)
+
+    def arrived(self, key, length):
+        with self.lock:
+            self.received += length
+            if key not in self.inflight:
+                return
+            sent_at, mark = self.inflight.pop(key)
+            rtt = time.time() - sent_at
+            if self.rate:
+                # time spent behind blocks that were already queued
+                rtt -= (self.received - mark) / self.rate
+            rtt = max(rtt, 0.001)
+            if self.rtt is None:
+                self.rtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.rtt - rtt)
+                self.rtt = 0.875 * self.rtt + 0.125 * rtt
+
+    def update(self, rate):
+        with self.lock:
+            self.rate = rate
+            if self.rtt is not None:
+                bdp = rate * (self.rtt + self.rttvar) / self.block_size
+                size = int(bdp * self.headroom) + 1
+                self.size = max(self.min_size, min(self.max_size, size))
+            return self.size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'rate': self.rate,
+                'rtt': self.rtt,
+                'rttvar': self.rttvar,
+                'inflight': len(self.inflight),
+            }
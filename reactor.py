@@ -0,0 +1,236 @@
+import collections
+import errno
+import select
+import socket
+import threading
+import traceback
+
+# same values as select.POLLIN/POLLOUT/POLLERR/POLLHUP and the epoll flags
+READ = 0x001
+WRITE = 0x004
+ERROR = 0x008 | 0x010
+
+poll_timeout = 1.0
+
+would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS,
+               getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+def Poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+
+class EpollPoller:
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def register(self, fd, events):
+        self.epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        return self.epoll.poll(timeout)
+
+
+class PollPoller:
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        return self.poller.poll(int(timeout * 1000))
+
+
+class SelectPoller:
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        if events & READ:
+            self.readers.add(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        r, w, x = select.select(self.readers, self.writers, self.readers,
+                                timeout)
+        events = collections.defaultdict(int)
+        for fd in r:
+            events[fd] |= READ
+        for fd in w:
+            events[fd] |= WRITE
+        for fd in x:
+            events[fd] |= ERROR
+        return events.items()
+
+
+class Reactor:
+
+    def __init__(self):
+        self.poller = Poller()
+        self.handlers = {}
+        self.calls = collections.deque()
+        self.running = False
+        self.thread = None
+        self.waker = Waker()
+        self.register(self.waker, READ)
+
+    def register(self, handler, events):
+        fd = handler.fileno()
+        self.handlers[fd] = handler
+        self.poller.register(fd, events)
+
+    def modify(self, handler, events):
+        self.poller.modify(handler.fileno(), events)
+
+    def unregister(self, handler):
+        fd = handler.fileno()
+        if self.handlers.get(fd) is handler:
+            del self.handlers[fd]
+            self.poller.unregister(fd)
+
+    def call(self, func, *args):
+        # the only thread safe entry point, everything else is only
+        # ever touched from the loop itself
+        self.calls.append((func, args))
+        if threading.current_thread() is not self.thread:
+            self.waker.wake()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.waker.wake()
+        if self.thread is not None and \
+               self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while self.running:
+            try:
+                events = self.poller.poll(poll_timeout)
+            except (IOError, OSError, select.error) as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, flags in events:
+                handler = self.handlers.get(fd)
+                if handler is None:
+                    continue
+                try:
+                    if flags & (READ | ERROR):
+                        handler.handle_read()
+                    if flags & WRITE and self.handlers.get(fd) is handler:
+                        handler.handle_write()
+                except Exception:
+                    traceback.print_exc()
+            self.run_calls()
+        self.run_calls()
+
+    def run_calls(self):
+        for i in range(len(self.calls)):
+            func, args = self.calls.popleft()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+
+class Waker:
+
+    def __init__(self):
+        # a loopback socket pair works with every poller on every platform
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.writer.connect(server.getsockname())
+        self.reader, addr = server.accept()
+        server.close()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.woken = False
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def wake(self):
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.writer.send('x')
+        except socket.error:
+            pass
+
+    def handle_read(self):
+        with self.lock:
+            self.woken = False
+        try:
+            self.reader.recv(4096)
+        except socket.error:
+            pass
+
+    def handle_write(self):
+        pass
+
+
+class Listener:
+
+    def __init__(self, sock, accept):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.accept = accept
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle_read(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error as err:
+                if err.args[0] in would_block:
+                    return
+                raise
+            self.accept(conn, addr)
+
+    def handle_write(self):
+        pass
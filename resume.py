@@ -0,0 +1,54 @@
+import os
+
+import bencode
+import bitfield
+
+save_interval = 300
+
+
+def resume_path(info, dl_dir):
+    return os.path.join(*(dl_dir + [info['name']])) + '.resume'
+
+def load(path, info_hash):
+    try:
+        with open(path, 'rb') as f:
+            record = bencode.bdecode_buffer(f.read(), text_keys=())
+        if record['info hash'] != info_hash:
+            return None
+        return {
+            'bitfield': record['bitfield'].tobytes(),
+            'blocks': [(index, list(bitfield.Bitfield(len(packed) * 8,
+                                                      packed.tobytes())))
+                       for index, packed in record['blocks']],
+            'files': [list(stat) for stat in record['files']],
+        }
+    except (EnvironmentError, KeyError, TypeError, ValueError):
+        return None
+
+def save(path, info_hash, pieceio, pieces):
+    # blocks still held in the assembly cache are not on disk yet
+    cached = pieceio.cache.cached()
+    blocks = []
+    for index, received in enumerate(pieces):
+        if pieceio.bitfield[index] or index in cached or not any(received):
+            continue
+        bf = bitfield.Bitfield(len(received))
+        for i, flag in enumerate(received):
+            if flag:
+                bf[i] = 1
+        blocks.append([index, bf.pack()])
+    record = {
+        'info hash': info_hash,
+        'bitfield': pieceio.bitfield.pack(),
+        'blocks': blocks,
+        'files': pieceio.file_stats(),
+    }
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        bencode.bencode_into(record, f)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
@@ -0,0 +1,208 @@
+import hashlib
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import availability
+import bitfield
+import peers
+import pieceio
+import reactor
+
+
+class Info(dict):
+
+    def __init__(self, name, payload, piece_size):
+        self.piece_size = piece_size
+        self.num_pieces = -(-len(payload) // piece_size)
+        self.pieces = [hashlib.sha1(payload[i:i + piece_size]).digest()
+                       for i in range(0, len(payload), piece_size)]
+        self['name'] = name
+        self['length'] = len(payload)
+        self['piece length'] = piece_size
+
+
+class MetaInfo:
+
+    def __init__(self, info):
+        self.info = info
+        self.info_hash = os.urandom(20)
+
+
+def wait_for(check, timeout=5):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.01)
+    return check()
+
+
+class AvailabilityTest(unittest.TestCase):
+
+    def test_counts(self):
+        ours = bitfield.Bitfield(16)
+        ours[0] = 1
+        avail = availability.Availability(16, ours)
+        bf = bitfield.Bitfield(16, '\xf0\x0f')
+        avail.add_bitfield(bf)
+        avail.add(5)
+        self.assertEqual(avail.rarity(1), 1)
+        self.assertEqual(avail.rarity(5), 1)
+        self.assertEqual(sorted(avail.rarest()),
+                         [1, 2, 3, 5, 12, 13, 14, 15])
+        avail.remove_bitfield(bf)
+        avail.remove(5)
+        self.assertEqual(avail.counts, [0] * 16)
+
+    def test_pieces_we_have(self):
+        ours = bitfield.Bitfield(16, '\xff\xff')
+        avail = availability.Availability(16, ours)
+        bf = bitfield.Bitfield(16, '\xff\x00')
+        avail.add_bitfield(bf)
+        avail.add_bitfield(bf)
+        avail.add(9)
+        self.assertEqual(avail.rarity(3), 2)
+        avail.remove_bitfield(bf)
+        avail.remove_bitfield(bf)
+        avail.remove(9)
+        self.assertEqual(avail.counts, [0] * 16)
+        self.assertEqual(avail.rarest(), [])
+
+    def test_rarest(self):
+        random.seed(0)
+        ours = bitfield.Bitfield(200)
+        avail = availability.Availability(200, ours)
+        for i in range(2000):
+            index = random.randrange(200)
+            if random.random() < 0.3 and avail.rarity(index):
+                avail.remove(index)
+            else:
+                avail.add(index)
+            if random.random() < 0.02:
+                ours[index] = 1
+                avail.have(index)
+        counts = [avail.rarity(i) for i in avail.rarest()]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(sorted(avail.rarest()), [i for i in range(200)
+            if avail.rarity(i) and not ours[i]])
+        bf = bitfield.Bitfield(200)
+        for i in range(0, 200, 3):
+            bf[i] = 1
+        exclude = set(range(0, 200, 2))
+        expected = [i for i in avail.rarest() if bf[i] and i not in exclude]
+        picked = avail.rarest(bf, 5, exclude)
+        self.assertEqual(len(picked), 5)
+        self.assertEqual(sorted(avail.rarity(i) for i in picked),
+                         sorted(avail.rarity(i) for i in expected[:5]))
+        for i in picked:
+            self.assertTrue(bf[i])
+            self.assertNotIn(i, exclude)
+
+    def test_bulk(self):
+        random.seed(0)
+        ours = bitfield.Bitfield(100)
+        ours[7] = 1
+        bitfields = []
+        for i in range(availability.bulk_threshold + 4):
+            bf = bitfield.Bitfield(100)
+            for j in random.sample(range(100), 30):
+                bf[j] = 1
+            bitfields.append(bf)
+        numpy = availability.numpy
+        try:
+            # the NumPy path when it is installed, and the plain one
+            for availability.numpy in set([numpy, None]):
+                self.check_bulk(ours, bitfields)
+        finally:
+            availability.numpy = numpy
+
+    def check_bulk(self, ours, bitfields):
+        avail = availability.Availability(100, ours)
+        avail.add(3)
+        avail.add_bitfields(bitfields)
+        self.assertEqual(avail.counts, [sum(bf[i] for bf in bitfields) +
+                                        (i == 3) for i in range(100)])
+        self.assertNotIn(7, avail.rarest())
+        counts = [avail.rarity(i) for i in avail.rarest()]
+        self.assertEqual(counts, sorted(counts))
+        avail.remove_bitfields(bitfields)
+        self.assertEqual(avail.rarest(), [3])
+        avail.remove(3)
+        self.assertEqual(avail.counts, [0] * 100)
+
+
+class SeederTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dl_dir = tempfile.mkdtemp()
+        payload = os.urandom(8 * 2**15)
+        with open(os.path.join(self.dl_dir, 'payload'), 'wb') as f:
+            f.write(payload)
+        self.metainfo = MetaInfo(Info('payload', payload, 2**15))
+        self.pieceio = pieceio.PieceIO(self.metainfo.info, [self.dl_dir])
+        self.seeder = peers.PeerManager(self.metainfo, os.urandom(20),
+            self.pieceio.bitfield, self.pieceio, lambda up=0, down=0: None,
+            lambda up=0, down=0, wasted=0: None, lambda index: True,
+            lambda event=0: None)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.seeder.reactor.register(reactor.Listener(self.server,
+            lambda sock, addr: self.seeder.add_peer(addr, None, sock)),
+            reactor.READ)
+        self.loop = reactor.Reactor()
+        self.loop.start()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.seeder.stop()
+        self.pieceio.close()
+        self.server.close()
+        shutil.rmtree(self.dl_dir)
+
+    def leecher(self, bits):
+        connected = threading.Event()
+        conn = peers.PeerConn(peers.Peer(self.server.getsockname(), None,
+            len(bits)), None, self.metainfo.info_hash, os.urandom(20), bits,
+            lambda conn: conn.close(), lambda up=0, down=0: None,
+            lambda up=0, down=0, wasted=0: None, lambda conn, *args: None,
+            self.loop, lambda conn: connected.set(), lambda: False)
+        conn.connect()
+        self.assertTrue(connected.wait(5))
+        return conn
+
+    def test_peers_connect_and_disconnect(self):
+        num_pieces = self.metainfo.info.num_pieces
+        partial = bitfield.Bitfield(num_pieces)
+        partial[1] = partial[6] = 1
+        leechers = [self.leecher(partial) for i in range(3)]
+        avail = self.seeder.availability
+        self.assertTrue(wait_for(lambda: avail.rarity(1) == 3))
+        for conn in leechers:
+            conn.close()
+        self.assertTrue(wait_for(lambda: not self.seeder.connections))
+        self.assertEqual(self.seeder.availability.counts, [0] * num_pieces)
+        self.assertEqual(self.seeder.unchoked, [])
+        self.assertEqual(self.seeder.peers_interested, [])
+
+    def test_drop_all(self):
+        num_pieces = self.metainfo.info.num_pieces
+        partial = bitfield.Bitfield(num_pieces)
+        partial[2] = 1
+        leechers = [self.leecher(partial) for i in range(3)]
+        avail = self.seeder.availability
+        self.assertTrue(wait_for(lambda: avail.rarity(2) == 3))
+        self.seeder.drop_all()
+        self.assertEqual(self.seeder.connections, [])
+        self.assertEqual(avail.counts, [0] * num_pieces)
+        self.assertEqual(self.seeder.peers_interested, [])
+        for conn in leechers:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import StringIO
+import cStringIO
+import io
+import tempfile
+import unittest
+
+import bencode
+
+
+class BufferDecoderTest(unittest.TestCase):
+
+    def test_decode(self):
+        data = bencode.bencode({'name': 'x', 'pieces': 'a' * 40,
+                                'list': [1, -2, 'ab']})
+        value = bencode.bdecode_buffer(data)
+        self.assertEqual(value['name'], u'x')
+        self.assertEqual(value['pieces'].tobytes(), 'a' * 40)
+        self.assertEqual(value['list'][:2], [1, -2])
+        self.assertEqual(bencode.materialize(
+            bencode.bdecode_buffer(data, lazy=True))['list'][2].tobytes(),
+            'ab')
+
+    def test_bad_data(self):
+        for data in ('-0:', '+3:abc', ' 3:abc', '3:ab', '03:abc', 'i03e',
+                     'i-0e', 'l', 'd1:ae', '3:abcd', 'x', ''):
+            self.assertRaises(ValueError, bencode.bdecode_buffer, data)
+            self.assertRaises(ValueError, bencode.bdecode_buffer, data,
+                              lazy=True)
+            self.assertRaises(ValueError, bencode.bdecode, data)
+            self.assertRaises(ValueError, bencode.bdecode_buffer,
+                              memoryview(bytearray(data)))
+
+    def test_buffer_types(self):
+        data = bencode.bencode({'name': 'x', 'peers': '\x7f\0\0\x01' * 8,
+                                'interval': 1800, 'list': ['a' * 100, 12]})
+        expected = bencode.materialize(bencode.bdecode_buffer(data))
+        buf = bytearray('xx' + data)
+        for value in (memoryview(buf)[2:], bytearray(data), buffer(data)):
+            for lazy in (False, True):
+                decoded = bencode.bdecode_buffer(value, lazy)
+                self.assertEqual(bencode.materialize(decoded), expected)
+        # binary values are views into the caller's buffer
+        peers = bencode.bdecode_buffer(memoryview(buf)[2:])['peers']
+        buf[buf.index('\x7f')] = '\x0a'
+        self.assertEqual(peers[0], '\x0a')
+
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_outputs(self):
+        obj = {'a': memoryview('xyz'), 'b': [buffer('uv'), bytearray('w')],
+               'c': u'\xe9', 'd': 3}
+        expected = bencode.bencode({'a': 'xyz', 'b': ['uv', 'w'],
+                                    'c': '\xc3\xa9', 'd': 3})
+        self.assertEqual(expected, 'd1:a3:xyz1:bl2:uv1:we1:c2:\xc3\xa91:di3ee')
+        for out in (StringIO.StringIO(), cStringIO.StringIO(), io.BytesIO()):
+            bencode.bencode_into(obj, out)
+            self.assertEqual(out.getvalue(), expected)
+        with tempfile.TemporaryFile() as f:
+            bencode.bencode_into(obj, f)
+            f.seek(0)
+            self.assertEqual(f.read(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import threading
+import unittest
+
+import diskio
+
+
+class DiskIOTest(unittest.TestCase):
+
+    def test_full_until_drained(self):
+        drained = threading.Event()
+        release = threading.Event()
+        pool = diskio.DiskIO(2, 8, drained.set)
+        pool.start()
+        try:
+            for i in range(8):
+                pool.submit(diskio.write_priority, None, release.wait, (5,),
+                            False)
+            self.assertTrue(pool.full())
+            release.set()
+            self.assertTrue(drained.wait(5))
+            self.assertFalse(pool.full())
+        finally:
+            release.set()
+            pool.stop()
+
+    def test_submit_does_not_block(self):
+        release = threading.Event()
+        pool = diskio.DiskIO(1, 2)
+        pool.start()
+        try:
+            for i in range(4):
+                pool.submit(diskio.upload_priority, None, release.wait, (5,),
+                            False)
+            self.assertEqual(pool.stats()['queued'], 4)
+            self.assertTrue(pool.full())
+        finally:
+            release.set()
+            pool.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import threading
+import types
+import unittest
+
+import availability
+import bitfield
+import peers
+
+
+class PieceIO:
+
+    def piece_length(self, index):
+        if index == 3:
+            return 2**15
+        return 2**18
+
+
+class DiskIO:
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, priority, key, func, args=(), block=True):
+        self.jobs.append(args)
+
+
+class Conn:
+
+    def __init__(self):
+        self.fastext_enabled = True
+        self.peer = peers.Peer(('127.0.0.1', 6881), None, 4)
+        self.rejected = []
+        self.interest = 0
+
+    def send_reject_request(self, index, begin, length):
+        self.rejected.append((index, begin, length))
+
+    def send_choke(self):
+        # what a connection that has been closed does
+        raise peers.DropConnection
+
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Conn()
+        self.manager = types.InstanceType(peers.PeerManager)
+        self.manager.bitfield = bitfield.Bitfield(4, '\xf0')
+        self.manager.pieceio = PieceIO()
+        self.manager.diskio = DiskIO()
+        self.manager.fast_allowed = []
+        self.manager.unchoked = [self.conn]
+        self.manager.peers_interested = [self.conn]
+        self.manager.pieces = [[0] * 16, [0] * 16, [0] * 16, [0] * 2]
+        self.wasted = 0
+
+        def update_udl(up=0, down=0, wasted=0):
+            self.wasted += wasted
+        self.manager.update_udl = update_udl
+
+    def test_accepted(self):
+        self.manager.handle_request(self.conn, 0, 2**17, 2**14)
+        self.manager.handle_request(self.conn, 3, 2**14, 2**14)
+        self.assertEqual(self.conn.rejected, [])
+        self.assertEqual(len(self.manager.diskio.jobs), 2)
+
+    def test_out_of_bounds(self):
+        requests = [(0, 0, 2**17 + 1), (0, 2**18 - 2**14, 2**14 + 1),
+                    (3, 2**14, 2**14 + 1), (3, 2**15, 1), (4, 0, 2**14),
+                    (2**32 - 1, 0, 2**14)]
+        for request in requests:
+            self.manager.handle_request(self.conn, *request)
+        self.assertEqual(self.conn.rejected, requests)
+        self.assertEqual(self.manager.diskio.jobs, [])
+
+    def test_pieces(self):
+        block = 'x' * 2**14
+        self.manager.handle_piece(self.conn, 3, 2**14, block)
+        self.assertEqual(len(self.manager.diskio.jobs), 1)
+        pieces = [(4, 0, block), (0, 2**18, block), (0, 1, block),
+                  (0, 0, block[1:]), (3, 2**15, block)]
+        for piece in pieces:
+            self.manager.handle_piece(self.conn, *piece)
+        self.assertEqual(len(self.manager.diskio.jobs), 1)
+        self.assertEqual(self.wasted, 5 * 2**14 - 1)
+
+
+
+class InterestTest(unittest.TestCase):
+
+    def test_have(self):
+        conn = Conn()
+        manager = types.InstanceType(peers.PeerManager)
+        manager.bitfield = bitfield.Bitfield(4, '\xc0')
+        manager.availability = availability.Availability(4, manager.bitfield)
+        manager.conns_lock = threading.Lock()
+        manager.connections = [conn]
+        manager.interested = [conn]
+        manager.availability.add(3)
+        for index in (3, 0, 2):
+            conn.peer.bitfield[index] = 1
+            manager.handle_msg(conn, peers.have_id, index)
+        self.assertEqual(conn.interest, 3)
+
+
+class ChokeTest(unittest.TestCase):
+
+    def test_choke_dropped_peer(self):
+        conn = Conn()
+        manager = types.InstanceType(peers.PeerManager)
+        manager.bitfield = bitfield.Bitfield(4, '\xf0')
+        manager.conns_lock = threading.Lock()
+        manager.connections = []
+        manager.peers_interested = []
+        manager.unchoked = [conn]
+        manager.upload_slots = peers.upload_slots
+        manager.optimistic = conn
+        manager.rechoke()
+        self.assertEqual(manager.unchoked, [])
+        self.assertEqual(manager.optimistic, None)
+        manager.choke_peer(conn)
+        self.assertEqual(manager.unchoked, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import random
+import time
+import unittest
+
+import availability
+import bitfield
+import picker
+
+block_size = 2**14
+
+
+class Info(dict):
+
+    def __init__(self, num_pieces, piece_size):
+        self.num_pieces = num_pieces
+        self.piece_size = piece_size
+
+
+class PickerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.num_pieces = 40
+        info = Info(self.num_pieces, 4 * block_size)
+        total_size = self.num_pieces * info.piece_size - block_size / 2
+        self.ours = bitfield.Bitfield(self.num_pieces)
+        self.avail = availability.Availability(self.num_pieces, self.ours)
+        self.picker = picker.PiecePicker(info, total_size, self.ours,
+                                         self.avail, block_size)
+
+    def peer(self, pieces=None):
+        bf = bitfield.Bitfield(self.num_pieces)
+        for i in range(self.num_pieces) if pieces is None else pieces:
+            bf[i] = 1
+        self.avail.add_bitfield(bf)
+        return bf
+
+    def complete(self, index):
+        self.ours[index] = 1
+        self.picker.completed(index)
+        self.avail.have(index)
+
+    def test_swarm_completes(self):
+        random.seed(0)
+        peers = [self.peer(random.sample(range(self.num_pieces), 15))
+                 for i in range(8)]
+        peers.append(self.peer())
+        received = [set() for i in range(self.num_pieces)]
+        outstanding = set()
+        while not self.ours.all():
+            endgame = self.picker.endgame()
+            progress = False
+            for bf in peers:
+                picked = self.picker.pick(bf, 3)
+                for index, begin, length in picked:
+                    block = index, begin
+                    if not endgame:
+                        self.assertNotIn(block, outstanding)
+                        self.assertNotIn(begin, received[index])
+                    outstanding.add(block)
+                    self.assertTrue(bf[index])
+                    self.assertFalse(self.ours[index])
+                for index, begin, length in picked:
+                    self.picker.received(index, begin)
+                    outstanding.discard((index, begin))
+                    received[index].add(begin)
+                    progress = True
+                    if len(received[index]) == self.picker.num_blocks(index):
+                        self.complete(index)
+            self.assertTrue(progress)
+        self.assertEqual(outstanding, set())
+        self.assertEqual(self.picker.pick(peers[-1], 10), [])
+
+    def test_partial_pieces_first(self):
+        seed = self.peer()
+        for index in range(picker.random_first):
+            self.complete(index)
+        first = self.picker.pick(seed, 1)
+        index = first[0][0]
+        other = self.peer([index, 20, 21, 22])
+        picked = self.picker.pick(other, 3)
+        self.assertEqual([block[0] for block in picked], [index] * 3)
+        self.assertNotIn(first[0], picked)
+
+    def test_restored_partial_first(self):
+        self.picker.restore(30, [True, False, True, False])
+        picked = self.picker.pick(self.peer(), 2)
+        self.assertEqual(picked, [(30, block_size, block_size),
+                                  (30, 3 * block_size, block_size)])
+
+    def test_failed_piece_picked_again(self):
+        bf = self.peer([7])
+        picked = self.picker.pick(bf, 10)
+        self.assertEqual(len(picked), self.picker.num_blocks(7))
+        for index, begin, length in picked:
+            self.picker.received(index, begin)
+        self.assertEqual(self.picker.pick(bf, 10), [])
+        self.picker.failed(7)
+        self.assertEqual(sorted(self.picker.pick(bf, 10)), sorted(picked))
+
+
+
+class LargeTorrentTest(unittest.TestCase):
+
+    def test_pick_cost(self):
+        num_pieces = 100000
+        info = Info(num_pieces, 16 * block_size)
+        ours = bitfield.Bitfield(num_pieces)
+        avail = availability.Availability(num_pieces, ours)
+        seeds = [bitfield.Bitfield(num_pieces, '\xff' * (num_pieces / 8))
+                 for i in range(2)]
+        for bf in seeds:
+            avail.add_bitfield(bf)
+        pp = picker.PiecePicker(info, num_pieces * info.piece_size, ours,
+                                avail, block_size)
+        start = time.time()
+        for i in range(50):
+            picked = pp.pick(seeds[i % 2], 16)
+            self.assertEqual(len(picked), 16)
+        for index in range(picker.random_first):
+            ours[index] = 1
+            avail.have(index)
+        lookups = []
+        rarest = avail.rarest
+        avail.rarest = lambda *args: lookups.append(args) or rarest(*args)
+        for i in range(50):
+            picked = pp.pick(seeds[i % 2], 64)
+            self.assertEqual(len(set(block[0] for block in picked)), 4)
+        self.assertEqual(len(lookups), 50)
+        self.assertLess((time.time() - start) / 100, 0.005)
+
+
+if __name__ == '__main__':
+    unittest.main()
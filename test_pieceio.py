@@ -0,0 +1,78 @@
+import threading
+import unittest
+
+import pieceio
+
+
+class Disk:
+
+    def __init__(self):
+        self.blocks = {}
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.cache = None
+        self.unlocked = []
+
+    def write_through(self, index, begin, data):
+        self.started.set()
+        self.release.wait(5)
+        unlocked = self.cache.lock.acquire(False)
+        if unlocked:
+            self.cache.lock.release()
+        self.unlocked.append(unlocked)
+        self.blocks[index, begin] = data
+
+
+class AssemblyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.disk = Disk()
+        self.cache = self.disk.cache = pieceio.AssemblyCache(self.disk, 8)
+
+    def test_assembled_in_memory(self):
+        self.cache.add(0, 2, 'cd')
+        self.cache.add(0, 0, 'ab')
+        self.assertEqual(self.cache.take(0, 4), 'abcd')
+        self.assertEqual(self.disk.blocks, {})
+
+    def test_spill_outside_lock(self):
+        self.cache.add(0, 0, 'abcd')
+        self.cache.add(1, 0, 'efgh')
+        self.disk.release.clear()
+        adder = threading.Thread(target=self.cache.add, args=(2, 0, 'ij'))
+        adder.start()
+        self.assertTrue(self.disk.started.wait(5))
+        # other pieces can still be cached while piece 0 is written
+        self.cache.add(1, 4, 'xy')
+        self.assertEqual(self.cache.cached(), set([1, 2]))
+        self.disk.release.set()
+        adder.join()
+        self.assertEqual(self.disk.unlocked, [True])
+        self.assertEqual(self.disk.blocks, {(0, 0): 'abcd'})
+        # later blocks of a spilled piece go straight to disk
+        self.cache.add(0, 4, 'klmn')
+        self.assertEqual(self.disk.blocks[0, 4], 'klmn')
+        self.assertEqual(self.cache.take(0, 8), None)
+
+    def test_take_waits_for_spill(self):
+        self.cache.add(0, 0, 'abcd')
+        self.disk.release.clear()
+        adder = threading.Thread(target=self.cache.add, args=(1, 0, 'efghi'))
+        adder.start()
+        self.assertTrue(self.disk.started.wait(5))
+        taken = []
+        taker = threading.Thread(target=lambda:
+                                 taken.append(self.cache.take(0, 4)))
+        taker.start()
+        taker.join(0.1)
+        self.assertEqual(taken, [])
+        self.disk.release.set()
+        taker.join(5)
+        adder.join(5)
+        self.assertEqual(taken, [None])
+        self.assertEqual(self.disk.blocks, {(0, 0): 'abcd'})
+
+
+if __name__ == '__main__':
+    unittest.main()
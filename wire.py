@@ -0,0 +1,180 @@
+import collections
+import errno
+import itertools
+import os
+import socket
+import struct
+
+buffer_size = 2**14
+large_message = 2**10
+coalesce_size = 2**12
+max_iov = 64
+
+length_prefix = struct.Struct('!I')
+header = struct.Struct('!IB')
+index_msg = struct.Struct('!IBI')
+request_msg = struct.Struct('!IBIII')
+piece_header = struct.Struct('!IBII')
+
+gather = hasattr(socket.socket, 'sendmsg')
+sendfile = getattr(os, 'sendfile', None)
+
+
+class MessageReader:
+
+    def __init__(self, limit, size=buffer_size, large=large_message):
+        self.limit = limit
+        self.large = large
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # a large message being received straight into its own buffer
+        self.pending = None
+        self.filled = 0
+
+    def recv_into(self, sock):
+        if self.pending is not None:
+            received = sock.recv_into(self.pending[self.filled:])
+            self.filled += received
+            return received
+        if self.end == len(self.buf):
+            self._compact()
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def take(self, size):
+        if self.end - self.start < size:
+            return None
+        data = self.view[self.start:self.start + size].tobytes()
+        self.start += size
+        return data
+
+    def messages(self):
+        # small messages are views into the shared buffer and only valid
+        # until the next read, large ones own their memory
+        while True:
+            if self.pending is not None:
+                if self.filled < len(self.pending):
+                    return
+                msg, self.pending = self.pending, None
+                yield msg
+                continue
+            available = self.end - self.start
+            if available < 4:
+                break
+            length, = length_prefix.unpack_from(self.buf, self.start)
+            if length > self.limit:
+                raise ValueError, 'message too long'
+            start = self.start + 4
+            if length > self.large:
+                self.filled = min(available - 4, length)
+                self.pending = memoryview(bytearray(length))
+                self.pending[:self.filled] = self.view[start:
+                                                       start + self.filled]
+                self.start = start + self.filled
+                continue
+            if available < 4 + length:
+                break
+            self.start = start + length
+            yield self.view[start:self.start]
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _compact(self):
+        size = self.end - self.start
+        self.view[:size] = self.view[self.start:self.end].tobytes()
+        self.start = 0
+        self.end = size
+
+
+class MessageWriter:
+
+    def __init__(self):
+        # small writes are copied together into one bytearray, large
+        # payloads are queued as they are when they can be sent with
+        # sendmsg, and copied into the batch otherwise
+        self.chunks = collections.deque()
+        self.offset = 0
+        self.size = 0
+
+    def write(self, *parts):
+        for data in parts:
+            if isinstance(data, FileSpan) or \
+                   gather and len(data) >= coalesce_size:
+                self.chunks.append(data)
+            else:
+                if not self.chunks or \
+                       not isinstance(self.chunks[-1], bytearray):
+                    self.chunks.append(bytearray())
+                self.chunks[-1] += data
+            self.size += len(data)
+
+    def prepend(self, data):
+        if self.offset:
+            raise ValueError, 'a write is already under way'
+        self.chunks.appendleft(data)
+        self.size += len(data)
+
+    def flush(self, sock):
+        while self.chunks:
+            sent, wanted = self._send(sock)
+            self._consume(sent)
+            if sent < wanted:
+                break
+        return not self.chunks
+
+    def clear(self):
+        for chunk in self.chunks:
+            if isinstance(chunk, FileSpan):
+                chunk.done()
+        self.chunks.clear()
+        self.offset = 0
+        self.size = 0
+
+    def _send(self, sock):
+        if isinstance(self.chunks[0], FileSpan):
+            span = self.chunks[0]
+            wanted = len(span) - self.offset
+            sent = sendfile(sock.fileno(), span.fd, span.offset + self.offset,
+                            wanted)
+            if not sent:
+                raise IOError, (errno.EIO, 'file ended before the block')
+            return sent, wanted
+        views = [memoryview(self.chunks[0])[self.offset:]]
+        try:
+            if gather:
+                views.extend(itertools.takewhile(
+                    lambda chunk: not isinstance(chunk, FileSpan),
+                    itertools.islice(self.chunks, 1, max_iov)))
+                return sock.sendmsg(views), sum(len(view) for view in views)
+            return sock.send(views[0]), len(views[0])
+        finally:
+            # the batch can only grow again once nothing points into it
+            del views[:]
+
+    def _consume(self, sent):
+        self.size -= sent
+        while sent:
+            left = len(self.chunks[0]) - self.offset
+            if sent < left:
+                self.offset += sent
+                return
+            sent -= left
+            chunk = self.chunks.popleft()
+            self.offset = 0
+            if isinstance(chunk, FileSpan):
+                chunk.done()
+
+
+class FileSpan:
+
+    def __init__(self, fd, offset, size, done):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.done = done
+
+    def __len__(self):
+        return self.size